@@ -10,35 +10,75 @@
 # Publisher - describe a single publisher, derived from Advertiser
 #
 # AdExchange - creation and management of Advertiser and Publisher instances
+#
+# The participants of an exchange are stored in a participants.ParticipantTable, the
+# Advertiser and Publisher instances are views of its rows.
 
 import networkx
+import numpy
 import csv
-import gurobipy
 import copy
+import os
+import shutil
+import io
+import hashlib
+import collections
+import json
+import solvers
+import participants
+import instrument
+import eligibility
+import horizon
+import geography
 
-class Advertiser:
-    # An instance defines a single advertiser
-    
-    advertiser_id = -1        
-    name = 'name'
+#record type of AdExchange.report_sparse_ads(binary=True)
+SPARSE_ADS_DTYPE = numpy.dtype([('advertiser','<i8'), ('publisher','<i8'), ('ads','<i8'), ('category','<i8')])
+
+class Advertiser(object):
+    # An instance defines a single advertiser.  The data is stored in a row of a
+    #  participants.ParticipantTable, an instance is a view of that row.  Constructing
+    #  an Advertiser directly stores it in its own one row table.
+
+    __slots__ = ('_table','_index')
+
+    def __init__(self, advertiser_id, name, business_type, ads_per_day, loc, prefered_pub_ids):
+        self._table = participants.ParticipantTable(1)
+        self._index = self._table.append(advertiser_id, name, business_type, ads_per_day, 0, loc, prefered_pub_ids, [], False)
+
+    @classmethod
+    def _view(cls, table, index):
+        #return an instance for row index of table
+        v = cls.__new__(cls)
+        v._table = table
+        v._index = index
+        return v
+
+    advertiser_id = property(lambda self: int(self._table.ids[self._index]))
+    name = property(lambda self: self._table.names[self._index])
     #type of business
-    business_type = 'Z'     
-    #number of ads credits
-    _ads_per_day = 0        
-    _ad_balance = 0
-    #list of prefered publishers
-    _prefered_pub_ids = []
+    business_type = property(lambda self: self._table.types[self._table.type_codes[self._index]])
     #geographic market
-    location = 'location'
+    location = property(lambda self: self._table.locations[self._table.loc_codes[self._index]])
 
-    def __init__(self, advertiser_id, name, business_type, ads_per_day, loc, prefered_pub_ids):
-        self.advertiser_id = advertiser_id
-        self.name = name
-        self.business_type = business_type
-        self._ads_per_day = ads_per_day
-        self._ad_balance = 0
-        self.location = loc
-        self._prefered_pub_ids = prefered_pub_ids
+    #number of ads credits
+    def _get_ads_per_day(self):
+        return int(self._table.ads_per_day[self._index])
+    def _set_ads_per_day(self, x):
+        self._table.ads_per_day[self._index] = x
+    _ads_per_day = property(_get_ads_per_day, _set_ads_per_day)
+
+    def _get_ad_balance(self):
+        return int(self._table.balance[self._index])
+    def _set_ad_balance(self, x):
+        self._table.balance[self._index] = x
+    _ad_balance = property(_get_ad_balance, _set_ad_balance)
+
+    #list of prefered publishers
+    def _get_prefered_pub_ids(self):
+        return self._table.prefered[self._index]
+    def _set_prefered_pub_ids(self, x):
+        self._table.prefered[self._index] = list(x)
+    _prefered_pub_ids = property(_get_prefered_pub_ids, _set_prefered_pub_ids)
 
     def __repr__(self):
         return self.name
@@ -79,15 +119,21 @@ class Advertiser:
 class Publisher(Advertiser):
     # An instance defines a single publisher
 
-    #maximum number of ads to publish
-    _pubs=0
-    #list of excluded advertisers
-    _excluded_ad_ids = []
+    __slots__ = ()
 
     def __init__(self, advertiser_id, name, business_type, ads_per_day, pubs, loc, prefered_pub_ids, excl_ad_ids):
-        Advertiser.__init__(self,advertiser_id,name,business_type,ads_per_day,loc,prefered_pub_ids)
-        self._pubs = pubs
-        self._excluded_ads = excl_ad_ids
+        self._table = participants.ParticipantTable(1)
+        self._index = self._table.append(advertiser_id, name, business_type, ads_per_day, pubs, loc, prefered_pub_ids, excl_ad_ids, True)
+
+    #maximum number of ads to publish
+    _pubs = property(lambda self: int(self._table.pubs[self._index]))
+
+    #list of excluded advertisers
+    def _get_excluded_ads(self):
+        return self._table.excluded[self._index]
+    def _set_excluded_ads(self, x):
+        self._table.excluded[self._index] = list(x)
+    _excluded_ads = property(_get_excluded_ads, _set_excluded_ads)
 
     def __str__(self):
         dlm = ', '
@@ -98,50 +144,193 @@ class Publisher(Advertiser):
 
     def allows(self, ad):
         #T/F this Publisher allows ads from Advertiser ad
-        return (ad.advertiser_id not in self._excluded_ad_ids) and (ad.business_type != self.business_type)
+        return (ad.advertiser_id not in self._excluded_ads) and (ad.business_type != self.business_type)
 
     def max_ads(self):
-        return Advertiser.max_ads(self) + self._pubs/2
+        return Advertiser.max_ads(self) + self._pubs//2
     
     def max_pubs(self):
         return self._pubs
 
     def update_balance_publisher(self, number_pubs):
-        self._ad_balance += (number_pubs+1)/2 #round up
+        self._ad_balance += (number_pubs+1)//2 #round up
+
+class _Column(object):
+    # A growable 1-d numpy array, optionally backed by a memory-mapped file
+
+    def __init__(self, dtype, path=None, capacity=1024):
+        self._dtype = numpy.dtype(dtype)
+        self._path = path
+        self._size = 0
+        self._data = self._allocate(capacity)
+
+    def __len__(self):
+        return self._size
+
+    def _allocate(self, capacity):
+        if self._path is None:
+            data = numpy.zeros(capacity, dtype=self._dtype)
+            if self._size > 0:
+                data[:self._size] = self._data[:self._size]
+            return data
+        if self._size == 0:
+            return numpy.memmap(self._path, dtype=self._dtype, mode='w+', shape=(capacity,))
+        #grow the file and map it again
+        self._data.flush()
+        self._data = None
+        with open(self._path, 'r+b') as f:
+            f.truncate(capacity*self._dtype.itemsize)
+        return numpy.memmap(self._path, dtype=self._dtype, mode='r+', shape=(capacity,))
+
+    def append(self, values):
+        values = numpy.asarray(values, dtype=self._dtype)
+        size = self._size + len(values)
+        if size > len(self._data):
+            self._data = self._allocate(max(size, 2*len(self._data)))
+        self._data[self._size:size] = values
+        self._size = size
+
+    def values(self):
+        #view of the stored values
+        return self._data[:self._size]
+
+class _EdgeIndex(object):
+    # The edges of each participant as advertiser (tail) and as publisher (head).  The
+    #  edges present when the index is built are sorted by tail and by head, as in a CSR
+    #  matrix, edges added later are kept in lists per participant.  The owner rebuilds
+    #  the index once the later edges are more than an eighth of all edges (see stale()).
+
+    def __init__(self, tails, heads, num_nodes):
+        self.size = len(tails)
+        self._added = 0
+        #stable sorts, so the edges of a participant are in increasing order
+        self._tail_order = numpy.argsort(tails, kind='mergesort')
+        self._tail_ptr = numpy.searchsorted(tails[self._tail_order], numpy.arange(num_nodes+1))
+        self._head_order = numpy.argsort(heads, kind='mergesort')
+        self._head_ptr = numpy.searchsorted(heads[self._head_order], numpy.arange(num_nodes+1))
+        self._later_out = {}
+        self._later_in = {}
+
+    def stale(self):
+        return self._added > max(1024, self.size//8)
+
+    def add(self, first, tails, heads):
+        #index the edges first, first+1, ... from tails to heads
+        for k,(t,h) in enumerate(zip(numpy.asarray(tails).tolist(), numpy.asarray(heads).tolist())):
+            self._later_out.setdefault(t, []).append(first+k)
+            self._later_in.setdefault(h, []).append(first+k)
+        self._added += len(tails)
+
+    def copy(self):
+        #an index that shares the sorted arrays, later edges added to either are not shared
+        cpy = copy.copy(self)
+        cpy._later_out = dict((ii,list(x)) for ii,x in self._later_out.items())
+        cpy._later_in = dict((ii,list(x)) for ii,x in self._later_in.items())
+        return cpy
+
+    def _edges(self, order, ptr, later, ii):
+        built = order[:0]
+        if ii+1 < len(ptr):
+            built = order[ptr[ii]:ptr[ii+1]]
+        if ii not in later:
+            return built
+        return numpy.concatenate([built, numpy.array(later[ii], dtype=int)])
+
+    def out_edges(self, ii):
+        #indices of the edges from advertiser ii, in increasing order
+        return self._edges(self._tail_order, self._tail_ptr, self._later_out, ii)
+
+    def in_edges(self, ii):
+        #indices of the edges to publisher ii, in increasing order
+        return self._edges(self._head_order, self._head_ptr, self._later_in, ii)
 
 class AdHistory:
-    # A class to store and access historical data from an AdExchange instance
-    _history = []  #list of historical AdExchange.  The solutions are unreliable since I can't store them 
+    # A class to store and access historical data from an AdExchange instance.  Each day
+    #  the nonzero entries of the solution and the balance of every participant are
+    #  appended to columns, indexed by day with pointer arrays (as in a CSR matrix).
+    #  The columns are kept in memory, or in memory-mapped files in the directory path.
+    #
+    # The reports need the category of each edge (see AdExchange._edge_categories()),
+    #  it is stored once for each distinct edge set and days refer to it by number.  The
+    #  edge arrays of an AdExchange are replaced, never changed in place, when its
+    #  participants change.
 
-    def __init__(self):
-        pass
+    def __init__(self, path=None):
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+        def column(name, dtype):
+            if path is None:
+                return _Column(dtype)
+            return _Column(dtype, os.path.join(path, name + '.dat'))
+
+        self._flow_ptr = column('flow_ptr', numpy.int64)  #entries of day ii are flow_ptr[ii]:flow_ptr[ii+1]
+        self._flow_ptr.append([0])
+        self._flow_index = column('flow_index', numpy.int64) #edge index of each nonzero
+        self._flow_value = column('flow_value', numpy.int64) #number of ads of each nonzero
+        self._balance_ptr = column('balance_ptr', numpy.int64)
+        self._balance_ptr.append([0])
+        self._balance = column('balance', numpy.int64)
+        self._structure = column('structure', numpy.int64) #edge set of each day
+        self._categories = [] #category of each edge, one array per edge set
+        self._last_edges = None
 
     def __len__(self):
-        return len(self._history)
+        return len(self._structure)
 
     def save(self, adex):
+        #append the current solution and balances of adex
+        edges = (adex._edge_tails, adex._edge_heads, adex._edge_prefered)
+        if self._last_edges is None or any(a is not b for a,b in zip(edges, self._last_edges)):
+            self._categories += [adex._edge_categories()]
+            self._last_edges = edges
+        self._structure.append([len(self._categories)-1])
 
-        self._history += [adex.copy()]
+        flow = numpy.asarray(adex._flow)
+        nz = numpy.nonzero(flow)[0]
+        self._flow_index.append(nz)
+        self._flow_value.append(flow[nz])
+        self._flow_ptr.append([len(self._flow_index)])
 
-    def report_total_ads(self):
-        #return a history of all ads published, split according t
-        hist = []
-        for adex in self._history:
-            hist += [adex.report_total_ads()]
+        self._balance.append(adex._participants.balance)
+        self._balance_ptr.append([len(self._balance)])
+
+    def _days(self, ptr):
+        #day of each entry of a column indexed by ptr
+        ptr = ptr.values()
+        return numpy.repeat(numpy.arange(len(ptr)-1), numpy.diff(ptr))
 
-        return hist
+    def report_total_ads(self):
+        #return a history of all ads published
+        totals = numpy.bincount(self._days(self._flow_ptr), self._flow_value.values(), len(self))
+        return totals.astype(int).tolist()
         
     def report_detailed_ads(self):
         #return a list containing prefered ad history, and number of ads split 
-        # according to distance
-        hist =[ [] ]
-        for adex in self._history:
-            day_data = adex.report_detailed_ads()
-            if len(day_data) > len(hist):
-                hist += [ [0] * len(hist[0]) ]
-            for ii,x in enumerate(day_data):
-                hist[ii] += [x]
-        return hist
+        # according to distance.  Row 0 is prefered ads, row i>0 is ads at distance i-1
+        days = self._days(self._flow_ptr)
+        index = self._flow_index.values()
+        value = self._flow_value.values()
+
+        #category of each entry, looked up in the edge set of its day
+        structure = self._structure.values()[days]
+        category = numpy.zeros(len(index), dtype=int)
+        for ii,cat in enumerate(self._categories):
+            on = structure == ii
+            category[on] = cat[index[on]]
+        on = value > 0
+
+        num_rows = 1
+        if on.any():
+            num_rows = int(category[on].max()) + 1
+        hist = numpy.zeros((num_rows, len(self)), dtype=int)
+        numpy.add.at(hist, (category[on], days[on]), value[on])
+        return hist.tolist()
+
+    def report_balances(self, day):
+        #return the balance of each participant at the end of day (counted from 0)
+        ptr = self._balance_ptr.values()
+        return self._balance.values()[ptr[day]:ptr[day+1]].tolist()
 
     def report_prefered_ad_distribution(self):
         #return a 6 element list for each advertiser giving (elements 0-4) how many ads
@@ -152,50 +341,94 @@ class AdHistory:
     
 class AdExchange:
     # A class for the entire exchange
-    _graph = []
     _map = []
-    _model = []
+    _solver = []
+    _participants = [] #participants.ParticipantTable of the advertisers and publishers
+    _nodes = []     #list of nodes, the node with index ii is a view of row ii of _participants
+    _edge_tails = []   #advertiser index of each edge, edges are ordered as the solver variables
+    _edge_heads = []   #publisher index of each edge
+    _edge_weights = [] #objective function coefficient of each edge
+    _edge_caps = []    #maximum number of ads on each edge
+    _edge_prefered = [] #T/F the advertiser prefers the publisher
+    _edge_dists = []   #distance between the advertiser and publisher of each edge
+    _edge_index = None #_EdgeIndex of the edges, see _edge_lookup()
+    _eligibility = None #eligibility.EligibilityIndex of the participants, see _eligibility_index()
+    _horizon = None    #(key, horizon.HorizonModel) of the last rolling horizon, see _solve_horizon()
+    _flow = []      #numpy array, number of ads on each edge in the current solution
+    _ads_cap = []   #advertising constraint of each node in the current solution
+    _pubs_cap = []  #publishing constraint of each node in the current solution
+    _distances = None  #distances between locations, see _distance_oracle()
+    _distance_cache = None #directory of the distance cache, see geography.distance_oracle()
+    _day = 0        #number of days solved
+    _instrument = None #instrument.Instrumentation, None when instrumentation is off
+    _top_k = None   #number of non-prefered publishers considered for each advertiser
+    _radius = None  #maximum distance of non-prefered publishers
 
-    def __init__(self, name='AdExchange',quiet=False):
-        #default constructor
-        self._graph = networkx.DiGraph()
+    def __init__(self, name='AdExchange',quiet=False,solver=None,top_k=None,radius=None):
+        #default constructor, solver is passed to solvers.make_solver().  If top_k or radius
+        # is given only the prefered edges and the top_k nearest publishers, or those
+        # within distance radius, of each advertiser are in the model
         self._map = networkx.DiGraph()
-        self._model = gurobipy.Model(name)
-        self._model.ModelSense = gurobipy.GRB.MAXIMIZE
-        if quiet:
-            self._model.setParam('OutputFlag',0)
-        
+        self._solver = solvers.make_solver(solver,name,quiet)
+        self._participants = participants.ParticipantTable()
+        self._nodes = []
+        self._edge_tails = []
+        self._edge_heads = []
+        self._edge_weights = []
+        self._edge_caps = []
+        self._edge_prefered = []
+        self._edge_dists = []
+        self._edge_index = None
+        self._eligibility = None
+        self._flow = []
+        self._ads_cap = []
+        self._pubs_cap = []
+        self._distances = None
+        self._distance_cache = None
+        self._day = 0
+        self._instrument = None
+        self._top_k = top_k
+        self._radius = radius
+
         self._build_map()
 
+    def instrumentation(self, on=True):
+        # turn instrumentation of the stages on (or off) and return the
+        #  instrument.Instrumentation that collects it
+        if not on:
+            self._instrument = None
+        elif self._instrument is None:
+            self._instrument = instrument.Instrumentation()
+        return self._instrument
+
+    @instrument.timed('copy')
     def copy(self):
-        # create a copy, gurobipy.LinExpr() attributes on each edge are not copied
-        #  If self has been optimized the copy may have a different optimal solution (of same obj value)
-        cpy = AdExchange()
-        cpy._model = self._model.copy()
-        cpy._model.optimize()
+        # create a copy, the current solution is copied rather than re-optimized
+        cpy = AdExchange(solver=self._solver.copy(),top_k=self._top_k,radius=self._radius)
         cpy._map = copy.copy(self._map)
-        cpy._graph = networkx.DiGraph()
-
-        copymorphism = {} #A map from vertices of self._graph to vertices of cpy._graph
-        for v in self._graph.nodes():
-            cpy_v = copy.copy(v)
-            copymorphism[v] = cpy_v
-            cpy._graph.add_node(cpy_v, lin_constr=[gurobipy.LinExpr(), gurobipy.LinExpr()])
-                                
-        for e in self._graph.edges():
-            cpy_u = copymorphism[e[0]]
-            cpy_v = copymorphism[e[1]]
-            cpy._graph.add_edge( cpy_u, cpy_v, var=cpy._model.getVarByName( e[0].name + str(e[0].advertiser_id) + '->' + e[1].name + str(e[1].advertiser_id)))
-
-            #if self._model.getAttr('Status') == 2: #if the self model has been optimized
-            #cpy._model.optimize()
+        cpy._participants = self._participants.copy()
+        cpy._add_nodes()
 
+        cpy._edge_tails = self._edge_tails
+        cpy._edge_heads = self._edge_heads
+        cpy._edge_weights = self._edge_weights
+        cpy._edge_caps = self._edge_caps
+        cpy._edge_prefered = self._edge_prefered
+        cpy._edge_dists = self._edge_dists
+        if self._edge_index is not None:
+            cpy._edge_index = self._edge_index.copy()
+        cpy._distances = self._distances
+        cpy._distance_cache = self._distance_cache
+        cpy._flow = numpy.array(self._flow)
+        cpy._ads_cap = numpy.array(self._ads_cap)
+        cpy._pubs_cap = numpy.array(self._pubs_cap)
+        cpy._day = self._day
         return cpy
 
     @classmethod
-    def from_sample_data(cls, quiet=False):
+    def from_sample_data(cls, quiet=False, solver=None, top_k=None, radius=None):
         #constructor from sample data
-        inst = cls('Sample',quiet)
+        inst = cls('Sample',quiet,solver,top_k,radius)
         inst._load_sample_data()
         inst._build_graph_model()
         inst.update()
@@ -220,108 +453,666 @@ class AdExchange:
             self._map.add_edge('N/A',v,distance=0)    
 
     def _load_sample_data(self):
-        #open the csv file
-        with open('../dat/AdData.csv') as f:
+        #load the sample data in dat/AdData.csv
+        self._load_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dat', 'AdData.csv'))
+
+    def _load_csv(self, path, chunksize=65536):
+        #append the participants in a csv file to the participant table, chunksize rows at
+        # a time.  The columns are: id, name, business type, publishing capacity (ads/2, or
+        # not a number for non-publishers), -, ads purchased, -, prefered publishers,
+        # location, excluded advertisers
+        with open(path) as f:
             r = csv.reader(f)
-            pref_pubs=[] #contains 1 list/advertiser of preferred publishers
-            excl_ads=[] #a tuple giving the excluded advertisers for each publisher
+            chunk = []
             for row in r:
-                a_id = int(row[0])
-                a_name = row[1]
-                a_type = row[2]
-                pref_pubs = map( int , row[7].split(',') )
-                a_loc=row[8]
-                if not self._map.has_node(a_loc):
-                    raise ValueError('Location ' + a_loc + ' is unknown')
-
-                a_ads = 0 
-                if row[5].isdigit(): 
-                    a_ads += int(row[5])    #Ads purchased from the bank
-
-                if row[3].isdigit():        #If this row describes a publisher
-                    a_pubs = int(row[3])*2  #Ads published in 1 day
-
-                    excl_ads = []
-                    if row[9]!='':
-                        excl_ads = map( int , row[9].split(',') )
-
-                    self._graph.add_node(Publisher(a_id, a_name, a_type, a_ads, a_pubs, a_loc, pref_pubs, excl_ads),lin_constr=[gurobipy.LinExpr(), gurobipy.LinExpr()])
-                else:
-                    self._graph.add_node(Advertiser(a_id, a_name, a_type, a_ads, a_loc, pref_pubs),lin_constr=[gurobipy.LinExpr(), gurobipy.LinExpr()])
+                chunk += [row]
+                if len(chunk) == chunksize:
+                    self._load_csv_rows(chunk)
+                    chunk = []
+            if len(chunk) > 0:
+                self._load_csv_rows(chunk)
         # End file read
+
+    def _load_csv_rows(self, rows):
+        #append a list of csv rows to the participant table
+        a_ids = [int(row[0]) for row in rows]
+        a_names = [row[1] for row in rows]
+        a_types = [row[2] for row in rows]
+        pref_pubs = [[int(x) for x in row[7].split(',')] for row in rows] #contains 1 list/advertiser of preferred publishers
+        a_locs = [row[8] for row in rows]
+        for a_loc in set(a_locs):
+            if not self._map.has_node(a_loc):
+                raise ValueError('Location ' + a_loc + ' is unknown')
+
+        a_ads = [int(row[5]) if row[5].isdigit() else 0 for row in rows] #Ads purchased from the bank
+        is_pub = [row[3].isdigit() for row in rows] #If this row describes a publisher
+        a_pubs = [int(row[3])*2 if row[3].isdigit() else 0 for row in rows] #Ads published in 1 day
+        excl_ads = [[int(x) for x in row[9].split(',')] if p and row[9]!='' else [] for row,p in zip(rows,is_pub)]
+
+        self._participants.extend(a_ids, a_names, a_types, a_ads, a_pubs, a_locs, pref_pubs, excl_ads, is_pub)
+
+    @classmethod
+    def from_csv(cls, path, name='AdExchange', quiet=False, solver=None, chunksize=65536, top_k=None, radius=None,
+                 map_path=None, cache_dir=None):
+        #constructor from a csv file with the columns of dat/AdData.csv.  The map is read
+        # from map_path if given, see load_map()
+        inst = cls(name,quiet,solver,top_k,radius)
+        if map_path is not None:
+            inst.load_map(map_path, cache_dir)
+        inst._load_csv(path, chunksize)
+        inst._build_graph_model()
+        inst.update()
+        return inst
+
+    def _snapshot_arrays(self):
+        #dictionary of numpy arrays describing the participants, their balances, the map and
+        # the pruning parameters
+        arrays = self._participants.to_arrays()
+        locations = list(self._map.nodes())
+        loc_index = dict((loc,ii) for ii,loc in enumerate(locations))
+        map_edges = list(self._map.edges(data=True))
+        arrays['map_nodes'] = numpy.array(locations)
+        arrays['map_tails'] = numpy.array([loc_index[e[0]] for e in map_edges], dtype=int)
+        arrays['map_heads'] = numpy.array([loc_index[e[1]] for e in map_edges], dtype=int)
+        arrays['map_distances'] = numpy.array([e[2]['distance'] for e in map_edges], dtype=float)
+        arrays['day'] = numpy.array(self._day)
+        arrays['top_k'] = numpy.array(-1 if self._top_k is None else self._top_k)
+        arrays['radius'] = numpy.array(numpy.nan if self._radius is None else self._radius)
+        return arrays
+
+    def save_snapshot(self, path):
+        #save the participants, their balances, the map and the pruning parameters as numpy
+        # files in the directory path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for key,arr in self._snapshot_arrays().items():
+            #replace the file, an exchange loaded from it keeps mapping the old one
+            f = os.path.join(path, key + '.npy')
+            with open(f + '.tmp', 'wb') as out:
+                numpy.save(out, arr)
+            os.replace(f + '.tmp', f)
+
+    @classmethod
+    def from_snapshot(cls, path, name='AdExchange', quiet=False, solver=None):
+        #constructor from a directory written by save_snapshot().  The files are memory
+        # mapped copy-on-write and the participant columns use the mapped arrays (see
+        # ParticipantTable.from_arrays()), the files do not change.  The balances and
+        # pruning parameters are restored, so the first update() continues the saved
+        # simulation
+        inst = cls(name,quiet,solver)
+        inst._load_snapshot(path)
+        inst._build_graph_model()
+        return inst
+
+    def _load_snapshot(self, path):
+        #replace the participants, balances and map with a snapshot, without building the model
+        arrays = {}
+        for f in os.listdir(path):
+            if f.endswith('.npy'):
+                arrays[f[:-4]] = numpy.load(os.path.join(path, f), mmap_mode='c')
+        self._load_snapshot_arrays(arrays)
+
+    def _load_snapshot_arrays(self, arrays):
+        #replace the participants, balances, map and pruning parameters with the arrays of
+        # _snapshot_arrays().  Snapshots without pruning parameters keep the current ones
+        self._map = networkx.DiGraph()
+        locations = arrays['map_nodes'].tolist()
+        self._map.add_nodes_from(locations)
+        for t,h,d in zip(arrays['map_tails'].tolist(), arrays['map_heads'].tolist(), arrays['map_distances'].tolist()):
+            self._map.add_edge(locations[t], locations[h], distance=d)
+        self._distances = None
+        self._eligibility = None
+
+        self._participants = participants.ParticipantTable.from_arrays(arrays)
+        if 'day' in arrays:
+            self._day = int(arrays['day'])
+        if 'top_k' in arrays:
+            top_k = int(arrays['top_k'])
+            self._top_k = None if top_k < 0 else top_k
+        if 'radius' in arrays:
+            radius = float(arrays['radius'])
+            self._radius = None if numpy.isnan(radius) else radius
+
+    # A checkpoint is a snapshot together with the model: the edges with their weights and
+    #  capacities, the pruning parameters and the current solution.  It is one numpy .npz
+    #  file, and restoring it rebuilds the solver from the edge arrays without computing
+    #  the eligible edges or solving, so a restored exchange is exactly the saved one.
+
+    _edge_columns = ['tails', 'heads', 'weights', 'caps', 'prefered', 'dists']
+
+    @instrument.timed('save_checkpoint')
+    def save_checkpoint(self, f):
+        #write a checkpoint to f, a file name or a binary file object
+        arrays = self._snapshot_arrays()
+        for col in self._edge_columns:
+            arrays['edge_' + col] = numpy.asarray(getattr(self, '_edge_' + col))
+        arrays['flow'] = numpy.asarray(self._flow, dtype=int)
+        arrays['ads_cap'] = numpy.asarray(self._ads_cap, dtype=int)
+        arrays['pubs_cap'] = numpy.asarray(self._pubs_cap, dtype=int)
+        arrays['solver'] = numpy.array(json.dumps(self._solver.settings()))
+        numpy.savez(f, **arrays)
+
+    @classmethod
+    def from_checkpoint(cls, f, name='AdExchange', quiet=False, solver=None):
+        #constructor from a checkpoint written by save_checkpoint(), f is a file name or a
+        # binary file object.  The next update() continues the saved simulation.  solver is
+        # passed to solvers.make_solver(), by default a solver of the saved kind and
+        # settings is created
+        with numpy.load(f) as npz:
+            arrays = dict(npz.items())
+        if solver is None and 'solver' in arrays:
+            solver = solvers.solver_from_settings(json.loads(str(arrays['solver'])), name, quiet)
+        inst = cls(name, quiet, solver)
+        inst._load_snapshot_arrays(arrays)
+        inst._add_nodes()
+        for col in cls._edge_columns:
+            setattr(inst, '_edge_' + col, arrays['edge_' + col])
+        inst._create_constraint_matrix()
+        inst._flow = arrays['flow']
+        inst._ads_cap = arrays['ads_cap']
+        inst._pubs_cap = arrays['pubs_cap']
+        return inst
+
+    def fork(self, name='AdExchange', quiet=False, solver=None):
+        #return an independent exchange restored from an in memory checkpoint of this one,
+        # solver is passed to solvers.make_solver(), by default a new solver with the
+        # settings of this exchange's solver
+        if solver is None:
+            solver = self._solver.fresh()
+        f = io.BytesIO()
+        self.save_checkpoint(f)
+        f.seek(0)
+        return AdExchange.from_checkpoint(f, name, quiet, solver)
+
+    def _add_nodes(self):
+        #a view of each participant
+        self._nodes = []
+        for ii,is_pub in enumerate(self._participants.is_publisher.tolist()):
+            if is_pub:
+                self._nodes += [Publisher._view(self._participants, ii)]
+            else:
+                self._nodes += [Advertiser._view(self._participants, ii)]
         
     def _build_graph_model(self):
-        #finish the networkx.Graph describing the instance, set-up the gurobi model
+        #create the edges describing the instance, set-up the solver
+        self._add_nodes()
         self._create_edges()
         self._create_constraint_matrix()
-       
+
+    # Participants join, leave and change between days without rebuilding the model.  Only
+    #  the edges of the participant change: new edges become new variables of the solver
+    #  and an edge that is no longer eligible is retired by setting its weight and
+    #  capacity to 0, so the edge indices (and the history) stay valid.  Balances are not changed.  The
+    #  edges are computed before anything changes, so a change that fails (an edge
+    #  without a path raises networkx.NetworkXNoPath) leaves the exchange as it was.
+    #
+    # The edges are found through the EligibilityIndex and _EdgeIndex, in Python work
+    #  proportional to the participant's edges and lists.  The edge arrays (and those of
+    #  the solver) are replaced, not grown in place, so copies and the history can share
+    #  them: each change also copies them, in time O(m) for m edges.
+
+    @instrument.timed('add_participant')
+    def add_participant(self, advertiser_id, name, business_type, ads_per_day, loc, prefered_pub_ids, pubs=None, excl_ad_ids=()):
+        #add an advertiser, or a publisher publishing pubs ads per day, and its edges
+        index = self._eligibility_index()
+        if index.row(advertiser_id) is not None:
+            raise ValueError('Participant ' + str(advertiser_id) + ' is already in the exchange')
+        if not self._map.has_node(loc):
+            raise ValueError('Location ' + loc + ' is unknown')
+        publisher = pubs is not None
+        if not publisher:
+            pubs = 0
+            excl_ad_ids = []
+        ii = self._participants.append(advertiser_id, name, business_type, ads_per_day, pubs, loc, prefered_pub_ids, excl_ad_ids, publisher)
+        index.add(ii)
+        try:
+            edges = self._participant_edge_arrays(ii)
+        except Exception:
+            index.remove(ii)
+            self._participants.pop()
+            raise
+        if publisher:
+            node = Publisher._view(self._participants, ii)
+        else:
+            node = Advertiser._view(self._participants, ii)
+        self._nodes += [node]
+        self._solver.add_nodes([name + str(advertiser_id)])
+        self._set_participant_edges(ii, *edges)
+        return node
+
+    @instrument.timed('remove_participant')
+    def remove_participant(self, advertiser_id):
+        #retire the participant and its edges, its row (and balance) is kept inactive
+        ii = self._find(advertiser_id)
+        self._eligibility_index().remove(ii)
+        self._participants.active[ii] = False
+        self._set_participant_edges(ii, *self._participant_edge_arrays(ii))
+
+    @instrument.timed('update_participant')
+    def update_participant(self, advertiser_id, ads_per_day=None, prefered_pub_ids=None, excl_ad_ids=None, pubs=None):
+        #change the ads purchased, prefered publishers, excluded advertisers or (publishers)
+        # publishing capacity of a participant, the arguments that are None are kept
+        table = self._participants
+        ii = self._find(advertiser_id)
+        if (excl_ad_ids is not None or pubs is not None) and not table.is_publisher[ii]:
+            raise ValueError('Participant ' + str(advertiser_id) + ' is not a publisher')
+        if prefered_pub_ids is None and excl_ad_ids is None and pubs is None:
+            #the ads purchased do not change the edges
+            if ads_per_day is not None:
+                table.ads_per_day[ii] = ads_per_day
+            return
+        old = (table.prefered[ii], table.excluded[ii], int(table.pubs[ii]))
+        if prefered_pub_ids is not None:
+            table.prefered[ii] = list(prefered_pub_ids)
+        if excl_ad_ids is not None:
+            table.excluded[ii] = list(excl_ad_ids)
+        if pubs is not None:
+            table.pubs[ii] = pubs
+        index = self._eligibility_index()
+        index.update(ii)
+        #advertisers that are no longer excluded may get an edge to ii again
+        readmit = index.rows(set(old[1]).difference(table.excluded[ii]))
+        try:
+            edges = self._participant_edge_arrays(ii, readmit)
+        except Exception:
+            table.prefered[ii],table.excluded[ii],table.pubs[ii] = old
+            index.update(ii)
+            raise
+        if ads_per_day is not None:
+            table.ads_per_day[ii] = ads_per_day
+        self._set_participant_edges(ii, *edges)
+
+    def _find(self, advertiser_id):
+        #row of the active participant with the given id, from the eligibility index
+        ii = self._eligibility_index().row(advertiser_id)
+        if ii is None:
+            raise KeyError('Participant ' + str(advertiser_id) + ' is not in the exchange')
+        return ii
+
+    def _eligibility_index(self):
+        #the eligibility.EligibilityIndex of the participants, built when first needed and
+        # kept up to date by the changes of participants
+        if self._eligibility is None:
+            self._eligibility = eligibility.EligibilityIndex(self._participants, self._distance_oracle())
+        return self._eligibility
+
+    def _participant_edge_arrays(self, ii, readmit=()):
+        #tails, heads, T/F prefered, distances, weights and capacities of the edges that
+        # participant ii should have, see _participant_edges()
+        tails,heads,pref = self._participant_edges(ii, readmit)
+        index = self._eligibility_index()
+        d = self._distance_oracle()[index.locs(tails),index.locs(heads)]
+        weights,caps = self._edge_attributes(tails, heads, pref, d)
+        return tails,heads,pref,d,weights,caps
+
+    def _set_participant_edges(self, ii, tails, heads, pref, d, weights, caps):
+        #make the edges of participant ii match the given edges: existing edges are
+        # updated or retired and the missing ones are added
+
+        #edges of ii in the model, every other edge is unchanged
+        lookup = self._edge_lookup()
+        old = numpy.union1d(lookup.out_edges(ii), lookup.in_edges(ii)).astype(int)
+        index = dict(zip(zip(self._edge_tails[old].tolist(), self._edge_heads[old].tolist()), old.tolist()))
+        on = numpy.array([(t,h) in index for t,h in zip(tails.tolist(), heads.tolist())], dtype=bool)
+        if len(old) > 0:
+            #edges that are no longer eligible get weight 0 and capacity 0
+            k = numpy.searchsorted(old, [index[(t,h)] for t,h in zip(tails[on].tolist(), heads[on].tolist())]).astype(int)
+            new_weights = numpy.zeros(len(old))
+            new_weights[k] = weights[on]
+            new_caps = numpy.zeros(len(old), dtype=int)
+            new_caps[k] = caps[on]
+            new_pref = self._edge_prefered[old]
+            new_pref[k] = pref[on]
+
+            self._edge_weights = self._edge_weights.copy()
+            self._edge_weights[old] = new_weights
+            self._edge_caps = self._edge_caps.copy()
+            self._edge_caps[old] = new_caps
+            self._edge_prefered = self._edge_prefered.copy()
+            self._edge_prefered[old] = new_pref
+            self._solver.update_edges(old, new_weights, new_caps)
+
+        add = ~on
+        if add.any():
+            m = len(self._edge_tails)
+            self._edge_tails = numpy.concatenate([self._edge_tails, tails[add]])
+            self._edge_heads = numpy.concatenate([self._edge_heads, heads[add]])
+            self._edge_prefered = numpy.concatenate([self._edge_prefered, pref[add]])
+            self._edge_dists = numpy.concatenate([self._edge_dists, d[add]])
+            self._edge_weights = numpy.concatenate([self._edge_weights, weights[add]])
+            self._edge_caps = numpy.concatenate([self._edge_caps, caps[add]])
+            lookup.add(m, tails[add], heads[add])
+            self._solver.add_edges(tails[add], heads[add], weights[add], caps[add])
+            self._flow = numpy.concatenate([numpy.asarray(self._flow, dtype=int), numpy.zeros(add.sum(), dtype=int)])
+
+    def _participant_edges(self, ii, readmit=()):
+        #the eligible edges of participant ii, as advertiser and as publisher, with the
+        # pruning of _create_edges().  Returns the same arrays as _eligible_edges().
+        #
+        # With pruning the edges to publisher ii are those of the advertisers that listed
+        # ii as a candidate: the live edges it has (weight > 0) and the advertisers that
+        # prefer it, less the ones it excludes.  The advertisers in readmit, no longer
+        # excluded, get their edge back if ii is one of their candidates.  A new
+        # publisher is a candidate of the advertisers that prefer it and, with radius and
+        # no top_k, those within radius.  The top_k lists of other advertisers are not
+        # revised
+        table = self._participants
+        if not table.active[ii]:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=bool)
+        index = self._eligibility_index()
+        pruned = self._top_k is not None or self._radius is not None
+
+        #ii as advertiser
+        p = index.prefered(ii)
+        if not pruned:
+            pubs = index.allows(ii, numpy.nonzero(table.is_publisher & table.active)[0])
+        else:
+            pubs = numpy.union1d(p, index.candidates(ii, self._top_k, self._radius)).astype(int)
+        tails = [numpy.zeros(len(pubs), dtype=int) + ii]
+        heads = [pubs]
+        pref = [numpy.isin(pubs, p)]
+
+        #ii as publisher
+        if table.is_publisher[ii]:
+            prefers = index.preferring(ii)
+            if not pruned:
+                ads = index.allowed(ii, numpy.nonzero(table.active)[0])
+            else:
+                e = self._edge_lookup().in_edges(ii)
+                found = [prefers, self._edge_tails[e[self._edge_weights[e] > 0]]]
+                found += [numpy.array([a for a in readmit if ii in index.candidates(a, self._top_k, self._radius)], dtype=int)]
+                if self._top_k is None:
+                    found += [index.near(ii, self._radius)]
+                ads = index.allowed(ii, numpy.unique(numpy.concatenate(found).astype(int)))
+                ads = ads[table.active[ads]]
+            tails += [ads]
+            heads += [numpy.zeros(len(ads), dtype=int) + ii]
+            pref += [numpy.isin(ads, prefers)]
+        return numpy.concatenate(tails), numpy.concatenate(heads), numpy.concatenate(pref)
+
+    @instrument.timed('update')
     def update(self):
         #solve the optimization problem for one day and update advertiser balances
         self._set_constraints()
-        self._model.optimize()
+        self._flow = self._solve()
+        self._update_balances()
 
-        for v in self._graph.nodes():
-            ads_placed = 0;
-            ads_published = 0;
-            
-            for e in self._graph.out_edges(v,data=True):
-                ads_placed += int(e[2]['var'].getAttr('X')) #will round down
-            for e in self._graph.in_edges(v,data=True):
-                ads_published += int(e[2]['var'].getAttr('X'))
-                
-            v.update_balance_advertiser(ads_placed)
-            v.update_balance_publisher(ads_published)
+    @instrument.timed('solve')
+    def _solve(self):
+        return self._solver.solve(self._ads_cap, self._pubs_cap)
+
+    @instrument.timed('update_balances')
+    def _update_balances(self):
+        #update the balances with the current solution and finish the day
+        n = len(self._nodes)
+        totals = self._solver.incidence.dot(self._flow).astype(int)
+        self._participants.update_balances(totals[:n], totals[n:])
+        self._day += 1
+
+    @instrument.timed('solve_horizon')
+    def _solve_horizon(self, window):
+        #the (fractional) flows of an optimal joint plan of the next window days, see
+        # horizon.py.  The model is kept for the next roll while the edges do not change
+        key = (len(self._nodes), window, self._edge_tails, self._edge_heads, self._edge_weights, self._edge_caps)
+        if self._horizon is None or any(a is not b for a,b in zip(key, self._horizon[0])):
+            model = horizon.HorizonModel(self._solver.incidence, self._edge_weights, self._edge_caps, window)
+            self._horizon = (key, model)
+        return list(self._horizon[1].solve(self._participants))
+
+    def _commit_planned(self, planned):
+        #finish today with the planned day rounded to today's capacities, no solve
+        self._set_constraints()
+        self._commit(horizon.round_day(planned, self._edge_tails, self._edge_heads, self._edge_weights, self._ads_cap, self._pubs_cap))
+
+    @instrument.timed('update')
+    def _commit(self, flow):
+        #finish today with the given flow, recorded as an update
+        self._set_constraints()
+        self._flow = flow
+        self._update_balances()
+
+    @instrument.timed('update_horizon')
+    def update_horizon(self, window, commit=1):
+        #plan the next window days jointly, with the balances linking the days, and keep
+        # the solution of the first commit days (rolling horizon).  One linear program is
+        # solved for the commit days, see horizon.py
+        for planned in self._solve_horizon(window)[:commit]:
+            self._commit_planned(planned)
+
+    def _state_key(self, structure):
+        #key of today's problem: the model structure and the balances
+        return structure, hashlib.sha1(numpy.ascontiguousarray(self._participants.balance).tobytes()).hexdigest()
+
+    def _memo_update(self, memo, memo_size, key):
+        #update(), with the solution of a state in memo replayed instead of solved.  memo
+        # maps a state key to the day it was solved and its solution, the least recently
+        # used of the memo_size states is evicted
+        if key in memo:
+            day,flow = memo.pop(key)
+            memo[key] = (day,flow)
+            self._commit(flow)
+            return
+        self.update()
+        memo[key] = (self._day-1, self._flow)
+        if len(memo) > memo_size:
+            memo.popitem(last=False)
+
+    def simulate(self, days, record=None, history=None, checkpoint_every=0, checkpoint_path=None, batch_size=1000,
+                 window=1, commit=1, memo_size=0):
+        #run update() until days days have been solved.  After each day the solution is
+        # saved to the AdHistory history, if given.  With window > 1 the days are planned
+        # by a rolling horizon instead, see update_horizon(): every commit days the next
+        # window days (or the days left, if fewer) are solved jointly.
+        #
+        # With memo_size > 0 the solutions of the last memo_size distinct balance vectors
+        # are kept, and a repeated state replays its solution instead of solving again.
+        # The balances then cycle, and without history, record and checkpoints whole
+        # periods of the cycle are skipped.
+        #
+        # record, if given, is called with batches of per-day metrics: a dictionary of numpy
+        # arrays with one entry (row) per day, 'day', 'total_ads', 'objective' and
+        # 'detailed_ads' (as in report_detailed_ads, one column per category).
+        #
+        # Every checkpoint_every days the exchange is saved to checkpoint_path with
+        # save_snapshot(), after emitting the pending metrics.  After a crash, continue with
+        # AdExchange.from_snapshot(checkpoint_path).simulate(days, ...), the days after the
+        # last checkpoint are solved (and recorded) again.
+        categories = self._edge_categories()
+        num_cat = 1
+        if len(categories) > 0:
+            num_cat = int(categories.max()) + 1
+
+        batch = {'day': numpy.zeros(batch_size, dtype=int),
+                 'total_ads': numpy.zeros(batch_size, dtype=int),
+                 'objective': numpy.zeros(batch_size),
+                 'detailed_ads': numpy.zeros((batch_size,num_cat), dtype=int)}
+        k = 0
+        plan = []
+        memo = collections.OrderedDict()
+        structure = None
+        if memo_size > 0:
+            structure = hashlib.sha1(b''.join(numpy.ascontiguousarray(a).tobytes() for a in
+                                              [self._edge_tails, self._edge_heads, self._edge_weights, self._edge_caps])).hexdigest()
+        fast_forward = history is None and record is None and checkpoint_every == 0
+        while self._day < days:
+            if window == 1 and memo_size > 0:
+                key = self._state_key(structure)
+                if fast_forward and key in memo:
+                    period = self._day - memo[key][0]
+                    self._day += (days - self._day)//period*period
+                    if self._day == days:
+                        break
+                self._memo_update(memo, memo_size, key)
+            elif window == 1:
+                self.update()
+            else:
+                if len(plan) == 0:
+                    plan = self._solve_horizon(min(window, days - self._day))[:commit]
+                self._commit_planned(plan.pop(0))
+            if history is not None:
+                history.save(self)
+
+            if record is not None:
+                batch['day'][k] = self._day
+                batch['total_ads'][k] = numpy.sum(self._flow)
+                batch['objective'][k] = numpy.dot(self._edge_weights, self._flow)
+                batch['detailed_ads'][k] = numpy.bincount(categories, self._flow, num_cat)
+                k += 1
+
+            checkpoint = checkpoint_every > 0 and self._day % checkpoint_every == 0
+            if record is not None and (k == batch_size or self._day == days or checkpoint):
+                record(dict((key,arr[:k].copy()) for key,arr in batch.items()))
+                k = 0
+            if checkpoint:
+                self._checkpoint(checkpoint_path)
+
+    def _checkpoint(self, path):
+        #replace the snapshot in path, the old snapshot is kept until the new one is complete
+        tmp = path + '.tmp'
+        old = path + '.old'
+        for d in [tmp, old]:
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+        self.save_snapshot(tmp)
+        if os.path.isdir(path):
+            os.rename(path, old)
+        os.rename(tmp, path)
+        if os.path.isdir(old):
+            shutil.rmtree(old)
         
+    @instrument.timed('create_edges')
     def _create_edges(self):
-        #create edges in the advertising network, add a variable for each edge to the model,
-        # and setup the objective function
-        #to hold the objective function
-        obj = gurobipy.LinExpr()
-        
-        #create the edges in the advertising graph and a model variable for each edge
-        for ad in self._graph.nodes():
-            for pub in self._graph.nodes():
-                if pub.allows(ad):
-                    if ad.prefers(pub):
-                        c = 2.0
-                    else:
-                        dist = networkx.shortest_path_length(self._map, ad.location, pub.location, 'distance')
-                        c = 1.0/(1+dist)
-                    e_var = self._model.addVar(lb=0,ub=(pub.max_pubs()/2),obj=c,name=(ad.name + str(ad.advertiser_id) + '->' + pub.name + str(pub.advertiser_id)))
-                    obj += c*e_var
-                    self._graph.add_edge( ad, pub, var=e_var)
-        #tell the model to incorporate the edges
-        self._model.update()
+        #create edges in the advertising network and the weight (objective function
+        # coefficient) and capacity of each edge.  Without pruning (top_k and radius None)
+        # every eligible edge is created, otherwise see _candidate_edges()
+        self._eligibility = None
+        table = self._participants
+        dist = self._distance_oracle()
+        locs = dist.codes(table.locations)[table.loc_codes]
 
-    def _create_constraint_matrix(self):
-        #lhs of the inequalities
+        if self._top_k is None and self._radius is None:
+            tails,heads,pref = self._eligible_edges()
+        else:
+            tails,heads,pref = self._candidate_edges()
+
+        d = dist[locs[tails],locs[heads]]
+        weights,caps = self._edge_attributes(tails, heads, pref, d)
+        self._edge_tails = tails
+        self._edge_heads = heads
+        self._edge_prefered = pref
+        self._edge_dists = d
+        self._edge_weights = weights
+        self._edge_caps = caps
+        self._edge_index = None
+
+    def _edge_lookup(self):
+        #the _EdgeIndex of the current edges, built when first needed
+        if self._edge_index is None or self._edge_index.stale():
+            self._edge_index = _EdgeIndex(self._edge_tails, self._edge_heads, len(self._nodes))
+        return self._edge_index
+
+    def _edge_attributes(self, tails, heads, pref, d):
+        #weight and capacity of the edges from tails to heads at distances d
+        table = self._participants
+        if numpy.isinf(d[~pref]).any():
+            k = numpy.nonzero(numpy.isinf(d) & ~pref)[0][0]
+            locations = [table.locations[table.loc_codes[ii]] for ii in [tails[k], heads[k]]]
+            raise networkx.NetworkXNoPath('No path from ' + locations[0] + ' to ' + locations[1])
+        pubs = numpy.where(table.is_publisher[heads] & table.active[heads], table.pubs[heads], 0)
+        return numpy.where(pref, 2.0, 1.0/(1+d)), pubs//2
+
+    def _eligible_edges(self):
+        #every eligible edge.  Returns advertiser indices, publisher indices and T/F the
+        # advertiser prefers the publisher, computed as n x n arrays with advertisers on
+        # the rows and publishers on the columns
+        table = self._participants
+        n = len(table)
+        active = numpy.nonzero(table.active)[0]
+        index = dict(zip(table.ids[active].tolist(), active.tolist()))
+        types = table.type_codes
+        is_pub = table.is_publisher
 
-        #clear old matrix
-        for v in self._graph.nodes():
-            self._graph.node[v]['lin_constr'][0].clear()
-            self._graph.node[v]['lin_constr'][1].clear()
+        #pub.allows(ad): publishers accept ads from other business types, except exclusions
+        allows = (types[:,numpy.newaxis] != types[numpy.newaxis,:]) & is_pub[numpy.newaxis,:]
+        allows &= (table.active[:,numpy.newaxis] & table.active[numpy.newaxis,:])
+        for jj,excl_ads in enumerate(table.excluded):
+            for a_id in excl_ads:
+                if a_id in index:
+                    allows[index[a_id],jj] = False
 
-        #build new constraint matrix
-        for e in self._graph.edges(data=True):
-            self._graph.node[e[0]]['lin_constr'][0] += e[2]['var'] #advertiser constraint
-            self._graph.node[e[1]]['lin_constr'][1] += e[2]['var'] #publisher constraint
+        #ad.prefers(pub)
+        prefers = numpy.zeros((n,n), dtype=bool)
+        for ii,pref_pubs in enumerate(table.prefered):
+            for p_id in pref_pubs:
+                if p_id in index:
+                    prefers[ii,index[p_id]] = True
+
+        tails,heads = numpy.nonzero(allows)  #row major, the order of the original double loop
+        return tails,heads,prefers[tails,heads]
+
+    def _candidate_edges(self):
+        #the prefered edges and, for each advertiser, the top_k nearest publishers or those
+        # within radius.  Returns the same arrays as _eligible_edges(), in the same order
+        index = self._eligibility_index()
+        tails = []
+        heads = []
+        pref = []
+        for ii in numpy.nonzero(self._participants.active)[0].tolist():
+            p = index.prefered(ii)
+            pubs = numpy.union1d(p, index.candidates(ii, self._top_k, self._radius)).astype(int)
+            tails += [numpy.zeros(len(pubs), dtype=int) + ii]
+            heads += [pubs]
+            pref += [numpy.isin(pubs, p)]
+        if len(tails) == 0:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=bool)
+        return numpy.concatenate(tails), numpy.concatenate(heads), numpy.concatenate(pref)
+
+    def check_pruning(self):
+        # solve today's problem with the pruned edges and with every eligible edge, return
+        #  both objective values.  The pruned model is exact for today if they are equal
+        full = AdExchange('Check', True, solvers.FlowSolver())
+        full._map = self._map
+        full._distances = self._distances
+        full._participants = self._participants
+        full._build_graph_model()
+        full._set_constraints()
+        self._set_constraints()
+        pruned = numpy.dot(self._edge_weights, self._solver.solve(self._ads_cap, self._pubs_cap))
+        return float(pruned), float(numpy.dot(full._edge_weights, full._solve()))
+
+    def _edge_categories(self):
+        #report category of each edge, 0 if prefered and 1+distance otherwise
+        cat = numpy.zeros(len(self._edge_tails), dtype=int)
+        far = ~self._edge_prefered
+        cat[far] = self._edge_dists[far].astype(int) + 1
+        return cat
+
+    def _distance_oracle(self):
+        #the geography.DistanceOracle of the map, shared by every exchange on the same map
+        if self._distances is None:
+            self._distances = geography.distance_oracle(self._map, self._distance_cache)
+        return self._distances
+
+    def load_map(self, path, cache_dir=None):
+        #replace the map with the location graph in a csv file (see geography.read_map),
+        # distances are cached in the directory cache_dir if given.  Call before the
+        # model is built
+        self._map = geography.read_map(path)
+        self._distances = None
+        self._eligibility = None
+        self._distance_cache = cache_dir
+
+    @instrument.timed('create_constraint_matrix')
+    def _create_constraint_matrix(self):
+        #hand the structure of the problem to the solver
+        labels = [v.name + str(v.advertiser_id) for v in self._nodes]
+        self._solver.build(len(self._nodes), self._edge_tails, self._edge_heads, self._edge_weights, self._edge_caps, labels)
             
+    @instrument.timed('set_constraints')
     def _set_constraints(self):
-
-        #set up the linear expressions for the constraint matrix
-        self._create_constraint_matrix()
-        
-        #remove any old constraints
-        for constr in self._model.getConstrs():
-            self._model.remove( constr )
-        self._model.update()
-
-        #add advertising and publishing constraints as appropriate
-        for v in self._graph.nodes():
-            self._model.addConstr(self._graph.node[v]['lin_constr'][0],gurobipy.GRB.LESS_EQUAL,v.max_ads(), v.name + '-' + str(v.advertiser_id) + ' ads') #advertising constraint
-            if self._graph.node[v]['lin_constr'][1].size() > 0: #don't bother to add empty constraints
-                self._model.addConstr(self._graph.node[v]['lin_constr'][1],gurobipy.GRB.LESS_EQUAL,v.max_pubs(), v.name + '-' + str(v.advertiser_id) + ' pubs') #publishing constraint
-        self._model.update()
+        #right hand sides of the advertising and publishing constraints for today
+        self._ads_cap = self._participants.max_ads()
+        self._pubs_cap = self._participants.max_pubs()
 
     def model_description(self):
         # return a string that describes the constraints
@@ -330,10 +1121,11 @@ class AdExchange:
                 +'of advertisements it will earn by publishing on that day.  Each publisher will accept no more than '\
                 +'half of its total ads from any one advertiser.'
 
+    @instrument.timed('report_solution_table')
     def report_solution_table(self):
         # return a table with the current solution
         ret = []        
-        nodes = self._graph.nodes()
+        nodes = self._nodes
         
         # column headers
         row = [' ']
@@ -344,20 +1136,22 @@ class AdExchange:
 
         # advertiser on row, publisher no column
         # number of ads placed at each publisher, total number placed, constraint
+        n = len(nodes)
+        cell = numpy.zeros((n,n), dtype=int) - 1 #edge index of each (advertiser, publisher), -1 if none
+        cell[self._edge_tails, self._edge_heads] = numpy.arange(len(self._edge_tails))
         colsum = [0]*len(nodes)
         row_constr_sum = 0
-        for u in nodes:
+        for jj,u in enumerate(nodes):
             row = [u.name]
             rowsum = 0
-            for ii,v in enumerate(nodes):
-                if self._graph.has_edge(u,v):
-                    row += [int( self._graph[u][v]['var'].getAttr('X') )]
+            for ii,k in enumerate(cell[jj].tolist()):
+                if k >= 0:
+                    row += [int( self._flow[k] )]
                     rowsum += row[-1]
                     colsum[ii] += row[-1]
                 else:
                     row += [' - ']
-            constr = self._model.getConstrByName(u.name + '-' + str(u.advertiser_id) + ' ads')
-            row += [rowsum, int( constr.getAttr('RHS') )]
+            row += [rowsum, int( self._ads_cap[jj] )]
             row_constr_sum += row[-1]
             ret += [row]
 
@@ -371,58 +1165,90 @@ class AdExchange:
         # constraints on publishers, sum of column constraints
         row = ['constraint']
         col_constr_sum = 0
-        for v in nodes:
-            constr = self._model.getConstrByName(v.name + '-' + str(v.advertiser_id) + ' pubs')
-            if constr is None:
+        in_degree = numpy.bincount(self._edge_heads, minlength=n)
+        for ii,v in enumerate(nodes):
+            if in_degree[ii] == 0: #no publishing constraint
                 row += [ 0 ]
             else:
-                row += [ int( constr.getAttr('RHS') ) ]
+                row += [ int( self._pubs_cap[ii] ) ]
                 col_constr_sum += row[-1]
         row += [col_constr_sum, ' ']
         ret += [row]
                 
         return ret
                 
+    def report_gap(self):
+        # return the objective value of the current solution and an upper bound on the
+        #  optimal value.  They are equal for exact solvers, for an approximate solver
+        #  (solver='greedy') a large difference calls for the exact path
+        objective = float(numpy.dot(self._edge_weights, self._flow))
+        if self._solver.bound is None:
+            return objective, objective
+        return objective, self._solver.bound
+
     def report_ad_balances(self):
         # return a list of current ad balances
         pass
 
+    @instrument.timed('report_total_ads')
     def report_total_ads(self):
         # return the total number of ads
-        ret = 0
-        for e in self._graph.edges(data=True):
-            ret += int(e[2]['var'].getAttr('X'))
-        return ret
+        return int(numpy.sum(self._flow))
 
+    @instrument.timed('report_detailed_ads')
     def report_detailed_ads(self):
         # report a list with 0th element as number of prefered adds, each index i>0
         # gives the number of ads at distance i-1.  The max distance having a positive
         # number of ads is the last reported (and determines the length of the output)
-        max_dist = self._map.number_of_nodes()
-        ret = [0]
-        for e in self._graph.edges(data=True):
-            e_ads = int(e[2]['var'].getAttr('X'))
-            if e_ads>0:
-                if e[0].prefers(e[1]):
-                    ret[0] += e_ads
-                else:
-                    k = int(networkx.shortest_path_length(self._map, e[0].location, e[1].location, 'distance'))
-                    if (len(ret)-1) <= k:  #extend the length of the returned vector
-                        ret += [0]*(k + 2 - len(ret))
-                    ret[k+1] = e_ads
-        return ret
+        flow = numpy.asarray(self._flow)
+        on = flow > 0
+        ret = numpy.bincount(self._edge_categories()[on], flow[on])
+        if len(ret) == 0:
+            return [0]
+        return ret.astype(int).tolist()
+
+    @instrument.timed('report_sparse_ads')
+    def report_sparse_ads(self, f, binary=False, header=True, chunksize=65536):
+        # write the edges with a positive number of ads to the file object f, one
+        # (advertiser id, publisher id, ads, category) record per edge.  The category is 0
+        # for prefered ads and 1+distance otherwise, as in report_detailed_ads.  Records are
+        # written as csv rows, or with binary=True as int64 records (numpy dtype
+        # SPARSE_ADS_DTYPE), chunksize at a time.
+        flow = numpy.asarray(self._flow)
+        nz = numpy.nonzero(flow > 0)[0]
+        ids = self._participants.ids
+        cat = self._edge_categories()
+
+        if not binary:
+            w = csv.writer(f)
+            if header:
+                w.writerow(['advertiser', 'publisher', 'ads', 'category'])
+        for k in range(0, len(nz), chunksize):
+            e = nz[k:k+chunksize]
+            rec = numpy.zeros(len(e), dtype=SPARSE_ADS_DTYPE)
+            rec['advertiser'] = ids[self._edge_tails[e]]
+            rec['publisher'] = ids[self._edge_heads[e]]
+            rec['ads'] = flow[e]
+            rec['category'] = cat[e]
+            if binary:
+                f.write(rec.tobytes())
+            else:
+                w.writerows(rec.tolist())
 
+    @instrument.timed('report_prefered_ad_details')
     def report_prefered_ad_details(self):
         #break prefered ads down according to publisher
         #return a dictionary where keys are advertisers and
         #values are number of prefered ads
 
         ret = {}
-        for ad in self._graph.nodes():
+        lookup = self._edge_lookup()
+        ids = self._participants.ids
+        for ii,ad in enumerate(self._nodes):
             vec = [0]*len(ad._prefered_pub_ids)
-            for pub in self._graph.nodes():
-                if ad.prefers(pub):
-                    vec[ ad._prefered_pub_ids.index(pub.advertiser_id) ] = int(self._graph[ad][pub]['var'].getAttr('X'))
+            for k in lookup.out_edges(ii).tolist():
+                if self._edge_prefered[k]:
+                    vec[ ad._prefered_pub_ids.index(int(ids[self._edge_heads[k]])) ] = int( self._flow[k] )
             ret[ad] = vec
 
         return ret
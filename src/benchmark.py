@@ -0,0 +1,101 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+# Time each stage of an AdExchange on synthetic exchanges of increasing size.
+#
+# usage: python benchmark.py [--sizes 50 100 200] [--solver flow] [--days 3] [--windows 1 3 7] [--output FILE]
+#
+# Each line of the output is a JSON record with the keys size, solver, edges, stage,
+# repeat and seconds.  The stages are create_edges, create_constraint_matrix (the solver
+# build), then per day set_constraints, solve, update_balances, history_save and the
+# reports.  Compare the output of two versions by (size, solver, stage).
+#
+# With --windows the simulation of --days days is also timed with each rolling horizon
+# window (stage simulate, window 1 is the day-by-day path), these records have the keys
+# window and objective (the total over all days) as well.
+
+import argparse
+import json
+import sys
+import timeit
+import io
+import advertiser
+import synthetic
+
+def time_stage(records, record, stage, f, *args):
+    #run f(*args), append a record with its wall time and return the result
+    start = timeit.default_timer()
+    ret = f(*args)
+    rec = dict(record)
+    rec['stage'] = stage
+    rec['seconds'] = timeit.default_timer() - start
+    records += [rec]
+    return ret
+
+def benchmark(size, solver='flow', days=3, seed=0, **kwargs):
+    #return a list of timing records for one synthetic exchange, kwargs are passed to
+    # synthetic.synthetic_exchange()
+    adex = synthetic.synthetic_exchange(size, seed=seed, solver=solver, build=False, **kwargs)
+    hist = advertiser.AdHistory()
+    records = []
+    record = {'size': size, 'solver': solver, 'repeat': 0}
+
+    adex._add_nodes()
+    time_stage(records, record, 'create_edges', adex._create_edges)
+    record['edges'] = len(adex._edge_tails)
+    records[-1]['edges'] = record['edges']
+    time_stage(records, record, 'create_constraint_matrix', adex._create_constraint_matrix)
+
+    for day in range(days):
+        record['repeat'] = day
+        time_stage(records, record, 'set_constraints', adex._set_constraints)
+        adex._flow = time_stage(records, record, 'solve', adex._solver.solve, adex._ads_cap, adex._pubs_cap)
+        time_stage(records, record, 'update_balances', adex._update_balances)
+        time_stage(records, record, 'history_save', hist.save, adex)
+        time_stage(records, record, 'report_total_ads', adex.report_total_ads)
+        time_stage(records, record, 'report_detailed_ads', adex.report_detailed_ads)
+        time_stage(records, record, 'report_sparse_ads', adex.report_sparse_ads, io.BytesIO(), True)
+        time_stage(records, record, 'report_solution_table', adex.report_solution_table)
+    return records
+
+def benchmark_horizon(size, windows, solver='flow', days=3, seed=0, commit=1, **kwargs):
+    #return a list of records of simulate() with each window on the same synthetic
+    # exchange, for the trade-off between throughput and objective value
+    records = []
+    for window in windows:
+        adex = synthetic.synthetic_exchange(size, seed=seed, solver=solver, build=False, **kwargs)
+        adex._build_graph_model()
+        batches = []
+        record = {'size': size, 'solver': solver, 'repeat': 0, 'edges': len(adex._edge_tails), 'window': window}
+        time_stage(records, record, 'simulate', lambda: adex.simulate(days, batches.append, window=window, commit=commit))
+        records[-1]['objective'] = float(sum([b['objective'].sum() for b in batches]))
+    return records
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the stages of AdExchange on synthetic exchanges')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50,100,200,400], help='numbers of participants')
+    parser.add_argument('--solver', default='flow', help="'flow', 'gurobi', 'greedy', 'components' or 'aggregate'")
+    parser.add_argument('--days', type=int, default=3, help='days solved for each size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--windows', type=int, nargs='*', default=[], help='rolling horizon windows to compare')
+    parser.add_argument('--output', default=None, help='output file, standard output by default')
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    if args.output is not None:
+        out = open(args.output, 'w')
+    try:
+        for size in args.sizes:
+            for rec in benchmark(size, args.solver, args.days, args.seed):
+                out.write(json.dumps(rec, sort_keys=True) + '\n')
+            if len(args.windows) > 0:
+                for rec in benchmark_horizon(size, args.windows, args.solver, args.days, args.seed):
+                    out.write(json.dumps(rec, sort_keys=True) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+
+# List of classes
+#
+# EligibilityIndex - find the publishers that may publish an advertiser's ads, nearest first
+#
+# A publisher allows ads from an advertiser of a different business type that is not on
+# its exclusion list (see Publisher.allows).  The index groups the publishers by location
+# and the distance oracle orders the locations by distance from each location, so the
+# candidates of an advertiser can be listed nearest first without looking at every
+# publisher.  It also groups the participants by location and by the publishers they
+# prefer, so the advertisers of a new publisher are found the same way.
+#
+# The index follows the changes of the table: call add(ii) after appending participant
+# ii, remove(ii) after it leaves and update(ii) after its prefered publishers or
+# exclusions change.  Each costs time proportional to the participant's lists and the
+# participants at its location.
+
+import numpy
+
+class EligibilityIndex(object):
+
+    def __init__(self, table, dist):
+        #table is a participants.ParticipantTable and dist the geography.DistanceOracle
+        # of the map
+        self._table = table
+        self._dist = dist
+        self._loc_numbers = dist.codes(table.locations) #location number of each location code
+        self._index = {}    #row of each active id
+        self._at = {}       #active participants at each location number, sorted arrays
+        self._pubs_at = {}  #active publishers at each location number, sorted arrays
+        self._excluded = {} #exclusion set of each active publisher with exclusions
+        self._prefers = {}  #rows of the active participants that prefer each publisher id
+        self._prefered = {} #prefered publisher ids of each active row, as indexed
+
+        active = numpy.nonzero(table.active)[0]
+        self._index = dict(zip(table.ids[active].tolist(), active.tolist()))
+        self._at = self._group(active)
+        self._pubs_at = self._group(active[table.is_publisher[active]])
+        for ii in active.tolist():
+            self._add_lists(ii)
+
+    def _group(self, rows):
+        #dictionary of the rows at each location number, sorted by row
+        locs = self.locs(rows)
+        order = numpy.argsort(locs, kind='mergesort')
+        rows = rows[order]
+        locs = locs[order]
+        starts = numpy.nonzero(numpy.diff(numpy.concatenate([[-1], locs])))[0]
+        ends = numpy.concatenate([starts[1:], [len(rows)]])
+        return dict((int(locs[a]), rows[a:b]) for a,b in zip(starts.tolist(), ends.tolist()))
+
+    def _add_lists(self, ii):
+        table = self._table
+        if table.is_publisher[ii] and len(table.excluded[ii]) > 0:
+            self._excluded[ii] = set(table.excluded[ii])
+        self._prefered[ii] = list(table.prefered[ii])
+        for p_id in self._prefered[ii]:
+            self._prefers.setdefault(p_id, set()).add(ii)
+
+    def _remove_lists(self, ii):
+        self._excluded.pop(ii, None)
+        for p_id in self._prefered.pop(ii, []):
+            self._prefers[p_id].discard(ii)
+
+    def row(self, p_id):
+        #row of the active participant with id p_id, None if there is none
+        return self._index.get(p_id)
+
+    def rows(self, ids):
+        #rows of the active participants among ids, in increasing order
+        return sorted(self._index[p_id] for p_id in ids if p_id in self._index)
+
+    def locs(self, rows):
+        #location numbers of the participants rows
+        table = self._table
+        if len(self._loc_numbers) < len(table.locations):
+            self._loc_numbers = self._dist.codes(table.locations)
+        return self._loc_numbers[table.loc_codes[numpy.asarray(rows, dtype=int)]]
+
+    def add(self, ii):
+        #index the participant ii, a new row of the table
+        table = self._table
+        loc = int(self.locs([ii])[0])
+        self._index[int(table.ids[ii])] = ii
+        self._at[loc] = numpy.append(self._at.get(loc, numpy.zeros(0, dtype=int)), ii)
+        if table.is_publisher[ii]:
+            self._pubs_at[loc] = numpy.append(self._pubs_at.get(loc, numpy.zeros(0, dtype=int)), ii)
+        self._add_lists(ii)
+
+    def remove(self, ii):
+        #forget the participant ii
+        loc = int(self.locs([ii])[0])
+        self._index.pop(int(self._table.ids[ii]), None)
+        for groups in [self._at, self._pubs_at]:
+            if loc in groups:
+                groups[loc] = groups[loc][groups[loc] != ii]
+        self._remove_lists(ii)
+
+    def update(self, ii):
+        #index the current prefered publishers and exclusions of participant ii
+        self._remove_lists(ii)
+        self._add_lists(ii)
+
+    def allows(self, ii, pubs):
+        #the publishers (indices) in pubs that allow ads from participant ii
+        pubs = pubs[self._table.type_codes[pubs] != self._table.type_codes[ii]]
+        if len(self._excluded) > 0:
+            a_id = self._table.ids[ii]
+            pubs = numpy.array([jj for jj in pubs.tolist() if a_id not in self._excluded.get(jj, ())], dtype=int)
+        return pubs
+
+    def allowed(self, jj, ads):
+        #the participants (indices) in ads whose ads publisher jj allows
+        ads = ads[self._table.type_codes[ads] != self._table.type_codes[jj]]
+        if jj in self._excluded:
+            excluded = numpy.array(sorted(self._excluded[jj]), dtype=int)
+            ads = ads[~numpy.isin(self._table.ids[ads], excluded)]
+        return ads
+
+    def prefered(self, ii):
+        #the prefered publishers of participant ii that allow its ads
+        pubs = [self._index[p_id] for p_id in self._table.prefered[ii] if p_id in self._index]
+        pubs = numpy.array(pubs, dtype=int)
+        if len(pubs) == 0:
+            return pubs
+        return self.allows(ii, pubs[self._table.is_publisher[pubs]])
+
+    def preferring(self, jj):
+        #the participants that prefer publisher jj and whose ads it allows, in increasing order
+        ads = numpy.array(sorted(self._prefers.get(int(self._table.ids[jj]), ())), dtype=int)
+        return self.allowed(jj, ads)
+
+    def near(self, jj, radius):
+        #the participants within distance radius of publisher jj (from their location to
+        # its location) whose ads it allows, in increasing order
+        locs = numpy.array(sorted(self._at), dtype=int)
+        if len(locs) == 0:
+            return numpy.zeros(0, dtype=int)
+        d = self._dist[locs, int(self.locs([jj])[0])]
+        found = [self._at[l] for l in locs[d <= radius].tolist()]
+        if len(found) == 0:
+            return numpy.zeros(0, dtype=int)
+        return self.allowed(jj, numpy.sort(numpy.concatenate(found)))
+
+    def candidates(self, ii, top_k=None, radius=None):
+        #publishers that allow ads from participant ii, nearest first.  Stops after top_k
+        # publishers (ties at the same distance are broken by index) or at distance larger
+        # than radius.  Unreachable locations are never candidates
+        loc = int(self.locs([ii])[0])
+        found = []
+        count = 0
+        for l in self._dist.order(loc).tolist():
+            d = self._dist[loc,l]
+            if numpy.isinf(d) or (radius is not None and d > radius):
+                break
+            if l not in self._pubs_at:
+                continue
+            pubs = self.allows(ii, self._pubs_at[l])
+            if top_k is not None:
+                pubs = pubs[:top_k-count]
+            found += [pubs]
+            count += len(pubs)
+            if top_k is not None and count >= top_k:
+                break
+        if len(found) == 0:
+            return numpy.zeros(0, dtype=int)
+        return numpy.concatenate(found)
@@ -0,0 +1,159 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+
+# List of classes
+#
+# DistanceOracle - shortest path distances between the locations of a map
+#
+# list of functions
+#
+# read_map(path): return the location map in a csv file
+# map_hash(graph): return a hash of a location map
+# distance_oracle(graph, cache_dir=None): return the DistanceOracle of a map, cached
+#
+# A map is a networkx.DiGraph of locations whose edges have a distance attribute.  In a
+# map file each row is a directed edge 'from,to,distance', or a single location.  The
+# oracles are cached in memory, and in cache_dir if it is given, keyed by map_hash() so
+# every exchange on the same map shares one oracle and the distances are computed once.
+
+import networkx
+import numpy
+import csv
+import hashlib
+import os
+
+def read_map(path):
+    #return the map in the csv file path
+    graph = networkx.DiGraph()
+    with open(path) as f:
+        for row in csv.reader(f):
+            if len(row) == 0 or row[0].startswith('#'):
+                continue
+            if len(row) == 1:
+                graph.add_node(row[0])
+            else:
+                graph.add_edge(row[0], row[1], distance=float(row[2]))
+    return graph
+
+def map_hash(graph):
+    #hash of the locations (in order) and the edges with their distances
+    h = hashlib.sha1()
+    for v in graph.nodes():
+        h.update(('n' + str(v) + '\n').encode('utf-8'))
+    for u,v,d in sorted((str(u),str(v),float(d)) for u,v,d in graph.edges(data='distance')):
+        h.update(('e' + u + '\t' + v + '\t' + repr(d) + '\n').encode('utf-8'))
+    return h.hexdigest()
+
+_oracles = {} #DistanceOracle of each map hash
+
+def distance_oracle(graph, cache_dir=None, dense_limit=2048):
+    #return the DistanceOracle of graph, from the cache if the map was seen before
+    key = map_hash(graph)
+    if key not in _oracles:
+        _oracles[key] = DistanceOracle(graph, cache_dir, dense_limit, key)
+    return _oracles[key]
+
+def _save(path, arr):
+    #write arr to the .npy file path, other processes never see a partial file
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f:
+        numpy.save(f, arr)
+    os.rename(tmp, path)
+
+class DistanceOracle(object):
+    # Distances between the locations of a map, numpy.inf if there is no path.  Locations
+    #  are numbered in the order of graph.nodes(), index maps a location to its number.
+    #  oracle[u,v] is the distance from u to v, u and v may be numbers or arrays.
+    #
+    # Maps with at most dense_limit locations store the all pairs matrix, saved in
+    #  cache_dir as <hash>.npy and memory-mapped by later processes.  For larger maps a
+    #  row (one Dijkstra from its location) is computed when it is first used and kept,
+    #  and saved in cache_dir as <hash>/<location number>.npy, so later processes
+    #  memory-map the rows computed before instead of running Dijkstra again.
+
+    def __init__(self, graph, cache_dir=None, dense_limit=2048, key=None):
+        self._graph = networkx.DiGraph(graph) #later changes of graph have another hash
+        self.locations = list(graph.nodes())
+        self.index = dict((loc,ii) for ii,loc in enumerate(self.locations))
+        self._rows = {}
+        self._order = {}
+        self._matrix = None
+        self._row_dir = None #directory of the saved rows, None without cache_dir
+        key = key or map_hash(graph)
+        if len(self.locations) <= dense_limit:
+            self._matrix = self._load_matrix(cache_dir, key)
+        elif cache_dir is not None:
+            self._row_dir = os.path.join(cache_dir, key)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def _load_matrix(self, cache_dir, key):
+        #all pairs matrix, read from or written to the cache
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, key + '.npy')
+            if os.path.exists(path):
+                return numpy.load(path, mmap_mode='r')
+        n = len(self.locations)
+        dist = numpy.empty((n,n))
+        dist.fill(numpy.inf)
+        for u,lengths in networkx.all_pairs_dijkstra_path_length(self._graph, weight='distance'):
+            for v,l in lengths.items():
+                dist[self.index[u],self.index[v]] = l
+        if path is not None:
+            _save(path, dist)
+        return dist
+
+    def row(self, u):
+        #distances from location number u to every location
+        if self._matrix is not None:
+            return self._matrix[u]
+        if u not in self._rows:
+            self._rows[u] = self._load_row(u)
+        return self._rows[u]
+
+    def _load_row(self, u):
+        #row u, read from or written to the cache
+        path = None
+        if self._row_dir is not None:
+            path = os.path.join(self._row_dir, str(u) + '.npy')
+            if os.path.exists(path):
+                return numpy.load(path, mmap_mode='r')
+        r = numpy.empty(len(self.locations))
+        r.fill(numpy.inf)
+        lengths = networkx.single_source_dijkstra_path_length(self._graph, self.locations[u], weight='distance')
+        for v,l in lengths.items():
+            r[self.index[v]] = l
+        if path is not None:
+            _save(path, r)
+        return r
+
+    def order(self, u):
+        #location numbers ordered by distance from u, ties by number
+        if u not in self._order:
+            self._order[u] = numpy.argsort(self.row(u), kind='mergesort')
+        return self._order[u]
+
+    def codes(self, locations):
+        #location numbers of a list of locations
+        return numpy.array([self.index[loc] for loc in locations], dtype=int)
+
+    def __getitem__(self, key):
+        u,v = key
+        if self._matrix is not None:
+            return self._matrix[u,v]
+        u = numpy.asarray(u)
+        v = numpy.asarray(v)
+        if u.ndim == 0:
+            return self.row(int(u))[v]
+        u,v = numpy.broadcast_arrays(u, v)
+        ret = numpy.empty(u.shape)
+        for x in numpy.unique(u).tolist():
+            on = u == x
+            ret[on] = self.row(x)[v[on]]
+        return ret
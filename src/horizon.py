@@ -0,0 +1,97 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+# List of classes
+#
+# HorizonModel - the linear program of a window of days over a fixed edge set
+#
+# list of functions
+#
+# round_day(planned,tails,heads,weights,ads_cap,pubs_cap): an integral flow for a planned
+#   day within today's capacities
+#
+# The daily problems are linked by the balances: the ads a participant may place on day
+# d depend on the ads it placed and published on the days before.  With x_d the flow on
+# day d, A and P the advertising and publishing rows of the incidence matrix, b the
+# balances today and a the ads purchased per day, the constraints of day d are
+#
+#   A x_d + sum_{e<d} (A x_e - P x_e/2) <= a + b + pubs//2 + d*a
+#   P x_d <= pubs
+#   0 <= x_d <= caps
+#
+# Publishers earn (P x_e + 1)//2 ads, at least P x_e/2, so the planned balances never
+# exceed the balances of the simulation.  The window is solved as a linear program with
+# scipy's HiGHS interface, whatever solver the exchange uses for single days, and its
+# plan may be fractional.  A day of the plan is committed without another solve (see
+# AdExchange.update_horizon): the plan is rounded down and, where the balances of the
+# simulation fall short of the planned balances, the edges of lowest weight give up
+# the ads that do not fit (round_day()).  With commit days kept from each window, one
+# linear program replaces commit daily solves.  The joint program is window times the
+# size of a day and is not totally unimodular, so on large exchanges it can take longer
+# than the daily solves it replaces: the mode plans for quality across the days, a
+# throughput gain needs a small window and commit close to window.
+
+import numpy
+import scipy.sparse
+import scipy.optimize
+
+class HorizonModel(object):
+    # The constraint matrix and bounds depend only on the edges and the window, they are
+    #  built once and every solve() only sets the right hand sides from the table, so a
+    #  rolling horizon reuses the model until the edges change.
+
+    def __init__(self, incidence, weights, caps, window):
+        #incidence, weights and caps describe the edges as in solvers.Solver
+        self.window = window
+        self.weights = weights
+        self.caps = caps
+        incidence = scipy.sparse.csr_matrix(incidence)
+        n = incidence.shape[0]//2
+        m = incidence.shape[1]
+        A = incidence[:n]
+        P = incidence[n:]
+
+        #day d sums the flows of days e<=d (advertising) and e<d (publishing)
+        lower = scipy.sparse.csr_matrix(numpy.tril(numpy.ones((window,window))))
+        strict = scipy.sparse.csr_matrix(numpy.tril(numpy.ones((window,window)), -1))
+        ads = scipy.sparse.kron(lower, A) - 0.5*scipy.sparse.kron(strict, P)
+        pubs = scipy.sparse.kron(scipy.sparse.identity(window), P)
+        self._matrix = scipy.sparse.vstack([ads, pubs]).tocsr()
+        self._bounds = numpy.stack([numpy.zeros(window*m), numpy.tile(numpy.asarray(caps, dtype=float), window)], axis=1)
+        self._objective = -numpy.tile(numpy.asarray(weights, dtype=float), window)
+        self._m = m
+
+    def solve(self, table):
+        #return a window x m array, row d is the (fractional) flow of day d of an optimal
+        # plan.  table is the participants.ParticipantTable with today's balances
+        window = self.window
+        per_day = numpy.where(table.active, table.ads_per_day, 0)
+        ads_ub = numpy.concatenate([table.max_ads() + d*per_day for d in range(window)])
+        pubs_ub = numpy.tile(table.max_pubs(), window)
+        res = scipy.optimize.linprog(self._objective, A_ub=self._matrix, b_ub=numpy.concatenate([ads_ub, pubs_ub]),
+                                     bounds=self._bounds, method='highs')
+        if not res.success:
+            raise RuntimeError('Horizon of ' + str(window) + ' days not solved: ' + res.message)
+        return numpy.maximum(res.x, 0.0).reshape((window,self._m))
+
+def round_day(planned, tails, heads, weights, ads_cap, pubs_cap):
+    #the planned (fractional) flow of a day rounded down, less the ads above ads_cap and
+    # pubs_cap, taken from the edges of lowest weight
+    flow = numpy.floor(planned + 1e-6).astype(int)
+    flow = _fit(flow, tails, weights, numpy.maximum(0, ads_cap))
+    return _fit(flow, heads, weights, numpy.maximum(0, pubs_cap))
+
+def _fit(flow, nodes, weights, caps):
+    #flow with the excess of each node over caps removed, lowest weight edges first
+    excess = numpy.bincount(nodes, flow, len(caps)).astype(int) - caps
+    if (excess <= 0).all():
+        return flow
+    order = numpy.lexsort((weights, nodes))
+    f = flow[order]
+    n = nodes[order]
+    total = numpy.cumsum(f)
+    before = total - f - (total - f)[numpy.searchsorted(n, n)] #flow of the node's earlier edges
+    flow = flow.copy()
+    flow[order] -= numpy.clip(excess[n] - before, 0, f)
+    return flow
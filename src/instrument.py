@@ -0,0 +1,77 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+
+# List of classes
+#
+# Instrumentation - wall time and counters of the stages of an AdExchange
+#
+# list of functions
+#
+# timed(stage): decorator for AdExchange methods, records the call if instrumentation is on
+#
+# Instrumentation is off unless AdExchange.instrumentation() is called, then a timed method
+# costs one attribute lookup and one extra function call.
+
+import functools
+import timeit
+
+def timed(stage):
+    #decorate a method of an object with an _instrument attribute (None when off)
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            inst = self._instrument
+            if inst is None:
+                return f(self, *args, **kwargs)
+            start = timeit.default_timer()
+            ret = f(self, *args, **kwargs)
+            inst.record(stage, timeit.default_timer() - start, self)
+            return ret
+        return wrapper
+    return decorate
+
+class Instrumentation(object):
+    # Wall time and call count of each stage, and counters for each day.  Every record
+    #  is a dictionary with the keys stage, seconds and day.  Records of the stage update
+    #  also have variables, constraints and iterations (None if the solver does not
+    #  count them) and are kept in days.  Hooks are called with every record.
+
+    def __init__(self):
+        self.calls = {}    #number of calls of each stage
+        self.seconds = {}  #total wall time of each stage
+        self.days = []     #record of each day finished by update(), a horizon commit or a memo replay
+        self._hooks = []
+
+    def add_hook(self, hook):
+        #call hook(record) after every timed call
+        self._hooks += [hook]
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def record(self, stage, seconds, adex):
+        rec = {'stage': stage, 'seconds': seconds, 'day': adex._day}
+        if stage == 'update':
+            rec['variables'] = len(adex._edge_tails)
+            rec['constraints'] = len(adex._solver.constr_rows)
+            rec['iterations'] = adex._solver.iterations
+            self.days += [rec]
+
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        for hook in self._hooks:
+            hook(rec)
+
+    def summary(self):
+        #return a table (with headers) of the calls and time of each stage, slowest first
+        ret = [['stage', 'calls', 'seconds', 'seconds/call']]
+        for stage in sorted(self.seconds, key=lambda s: -self.seconds[s]):
+            ret += [[stage, self.calls[stage], self.seconds[stage], self.seconds[stage]/self.calls[stage]]]
+        return ret
+
+    def dump(self, f):
+        #write the summary to the file object f
+        for row in self.summary():
+            f.write('\t'.join([str(x) for x in row]) + '\n')
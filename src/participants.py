@@ -0,0 +1,203 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+
+# List of classes
+#
+# ParticipantTable - columnar storage for the advertisers and publishers of an exchange
+#
+# Each participant is a row of the table, identified by a dense integer index.  Rows are
+# never deleted, a participant that leaves the exchange is marked inactive.  The
+# fixed size columns are numpy arrays, so the daily constraints and balance updates are
+# vectorized operations over the whole exchange.  Business types and locations are
+# stored as integer codes into the lists types and locations.  Advertiser and Publisher
+# instances are views of one row.
+
+import numpy
+import copy
+
+class ParticipantTable(object):
+    # Columnar storage for participants.  The arrays are allocated with spare capacity
+    #  and the column properties return views of the first len(self) rows.
+
+    _columns = [('_ids',int), ('_names',object), ('_type_codes',int), ('_loc_codes',int),
+                ('_ads_per_day',int), ('_balance',int), ('_pubs',int), ('_is_publisher',bool),
+                ('_active',bool)]
+
+    def __init__(self, capacity=16):
+        self._size = 0
+        for col,dtype in self._columns:
+            setattr(self, col, numpy.zeros(capacity, dtype=dtype))
+        self.prefered = []  #list of prefered publisher ids of each row
+        self.excluded = []  #list of excluded advertiser ids of each row
+        self.types = []     #business type of each type code
+        self.locations = [] #location of each location code
+        self._type_index = {}
+        self._loc_index = {}
+
+    def __len__(self):
+        return self._size
+
+    ids = property(lambda self: self._ids[:self._size])
+    names = property(lambda self: self._names[:self._size])
+    type_codes = property(lambda self: self._type_codes[:self._size])
+    loc_codes = property(lambda self: self._loc_codes[:self._size])
+    ads_per_day = property(lambda self: self._ads_per_day[:self._size])
+    balance = property(lambda self: self._balance[:self._size])
+    pubs = property(lambda self: self._pubs[:self._size])
+    is_publisher = property(lambda self: self._is_publisher[:self._size])
+    active = property(lambda self: self._active[:self._size])
+
+    def type_code(self, business_type):
+        #integer code of a business type, new types are added to the list types
+        if business_type not in self._type_index:
+            self._type_index[business_type] = len(self.types)
+            self.types += [business_type]
+        return self._type_index[business_type]
+
+    def loc_code(self, location):
+        #integer code of a location, new locations are added to the list locations
+        if location not in self._loc_index:
+            self._loc_index[location] = len(self.locations)
+            self.locations += [location]
+        return self._loc_index[location]
+
+    def _reserve(self, size):
+        #make room for at least size rows
+        capacity = len(self._ids)
+        if size <= capacity:
+            return
+        capacity = max(size, 2*capacity)
+        for col,dtype in self._columns:
+            arr = numpy.zeros(capacity, dtype=dtype)
+            arr[:self._size] = getattr(self, col)[:self._size]
+            setattr(self, col, arr)
+
+    def append(self, advertiser_id, name, business_type, ads_per_day, pubs, loc, prefered_pub_ids, excl_ad_ids, publisher):
+        #add one participant and return its index
+        ii = self._size
+        self._reserve(ii+1)
+        self._ids[ii] = advertiser_id
+        self._names[ii] = name
+        self._type_codes[ii] = self.type_code(business_type)
+        self._loc_codes[ii] = self.loc_code(loc)
+        self._ads_per_day[ii] = ads_per_day
+        self._balance[ii] = 0
+        self._pubs[ii] = pubs
+        self._is_publisher[ii] = publisher
+        self._active[ii] = True
+        self.prefered += [list(prefered_pub_ids)]
+        self.excluded += [list(excl_ad_ids)]
+        self._size += 1
+        return ii
+
+    def extend(self, advertiser_ids, names, business_types, ads_per_day, pubs, locs, prefered, excluded, publisher):
+        #add many participants, each argument is a list or array with one entry per participant
+        m = len(advertiser_ids)
+        ii = self._size
+        self._reserve(ii+m)
+        self._ids[ii:ii+m] = advertiser_ids
+        self._names[ii:ii+m] = names
+        self._type_codes[ii:ii+m] = self._codes(business_types, self.type_code)
+        self._loc_codes[ii:ii+m] = self._codes(locs, self.loc_code)
+        self._ads_per_day[ii:ii+m] = ads_per_day
+        self._balance[ii:ii+m] = 0
+        self._pubs[ii:ii+m] = pubs
+        self._is_publisher[ii:ii+m] = publisher
+        self._active[ii:ii+m] = True
+        self.prefered += [list(x) for x in prefered]
+        self.excluded += [list(x) for x in excluded]
+        self._size += m
+
+    def pop(self):
+        #remove the last row, undoing append().  Its type and location codes are kept
+        self._size -= 1
+        self.prefered.pop()
+        self.excluded.pop()
+
+    def find(self, advertiser_id):
+        #index of the active participant with the given id
+        found = numpy.nonzero((self.ids == advertiser_id) & self.active)[0]
+        if len(found) == 0:
+            raise KeyError('Participant ' + str(advertiser_id) + ' is not in the exchange')
+        return int(found[0])
+
+    def _codes(self, values, code):
+        #integer codes for a list of values, one call of code() per distinct value
+        if len(values) == 0:
+            return []
+        unique,inverse = numpy.unique(numpy.asarray(values), return_inverse=True)
+        return numpy.array([code(u) for u in unique.tolist()], dtype=int)[inverse]
+
+    def to_arrays(self):
+        #return a dictionary of numpy arrays describing the table, see from_arrays()
+        arrays = {}
+        for col,dtype in self._columns:
+            arrays[col[1:]] = getattr(self, col)[:self._size]
+        arrays['names'] = numpy.array(self.names.tolist()) #fixed width strings
+        arrays['types'] = numpy.array(self.types)
+        arrays['locations'] = numpy.array(self.locations)
+        for col in ['prefered','excluded']:
+            lists = getattr(self, col)
+            arrays[col + '_ptr'] = numpy.cumsum([0] + [len(x) for x in lists])
+            arrays[col + '_ids'] = numpy.array([a_id for x in lists for a_id in x], dtype=int)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        #create a table from a dictionary of arrays returned by to_arrays().  Arrays of the
+        # column's type become the column as they are, so columns memory-mapped with
+        # numpy.load(mmap_mode='c') are read when they are used and copied only in the
+        # pages that change.  The first append moves the columns to new arrays.  The
+        # names and the prefered and excluded lists are Python objects and are created
+        # here, which reads those arrays in full; building the model reads every list anyway
+        size = len(arrays['ids'])
+        table = cls(0)
+        for col,dtype in cls._columns:
+            if col[1:] in arrays and col != '_names':
+                setattr(table, col, numpy.asarray(arrays[col[1:]]).astype(dtype, copy=False))
+            else:
+                setattr(table, col, numpy.zeros(size, dtype=dtype))
+        table._names[:] = numpy.asarray(arrays['names']).tolist()
+        if 'active' not in arrays: #snapshots without removed participants
+            table._active[:] = True
+        table._size = size
+        for x in arrays['types'].tolist():
+            table.type_code(x)
+        for x in arrays['locations'].tolist():
+            table.loc_code(x)
+        for col in ['prefered','excluded']:
+            ptr = numpy.asarray(arrays[col + '_ptr'])
+            ids = numpy.asarray(arrays[col + '_ids']).tolist()
+            setattr(table, col, [ids[ptr[ii]:ptr[ii+1]] for ii in range(size)])
+        return table
+
+    def max_ads(self):
+        #maximum number of ads each participant may place today
+        ret = self.ads_per_day + self.balance + numpy.where(self.is_publisher, self.pubs//2, 0)
+        return numpy.where(self.active, ret, 0)
+
+    def max_pubs(self):
+        #maximum number of ads each participant may publish today
+        return numpy.where(self.is_publisher & self.active, self.pubs, 0)
+
+    def update_balances(self, ads_placed, ads_published):
+        #update every balance after a day with the given number of ads placed and published
+        # by each participant, publishers earn half of the ads they publish (rounded up).
+        # The balances of inactive participants are kept as they are
+        self.balance[:] += numpy.where(self.active, self.ads_per_day - ads_placed, 0)
+        self.balance[:] += numpy.where(self.is_publisher & self.active, (numpy.asarray(ads_published)+1)//2, 0)
+
+    def copy(self):
+        #return an independent copy of the table
+        cpy = copy.copy(self)
+        for col,dtype in self._columns:
+            setattr(cpy, col, getattr(self, col).copy())
+        cpy.prefered = [list(x) for x in self.prefered]
+        cpy.excluded = [list(x) for x in self.excluded]
+        cpy.types = list(self.types)
+        cpy.locations = list(self.locations)
+        cpy._type_index = dict(self._type_index)
+        cpy._loc_index = dict(self._loc_index)
+        return cpy
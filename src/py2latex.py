@@ -6,9 +6,14 @@
 #
 # tabular(A,spec='',hline=False): print the 2-d list A to a string as a latex tabular
 # tabular_rows(A,hline=False): print the 2-d list A to a string as rows in a latex tabular
+# decimate(x,Y,max_points,method='lttb'): reduce the series in the rows of Y to at most max_points points
 # tabular_caps(spec=''): return the latex code to start and finish a tabular as strings
 # table(A,spec=''): print the 2-d list A to a string as a latex table
 # table_caps(): print the latex code to start and finish a table as strings
+#
+# Functions named iter_* yield the same latex code in chunks, and write_chunks(f,chunks)
+# writes them to a file object, so large tables and plots can go straight to disk.
+# The string versions join the chunks.
 
 import pdb
 import copy
@@ -18,32 +23,41 @@ def tabular_caps(spec=''):
     bot = '\n\\end{tabular}'
     return top,bot
 
+def write_chunks(f,chunks):
+    #write an iterable of strings to the file object f
+    for chunk in chunks:
+        f.write(chunk)
+
 def tabular_rows(A,hline=False):
+    return ''.join(iter_tabular_rows(A,hline))
+
+def iter_tabular_rows(A,hline=False):
     eol = '\\\\\n'
     bol = ''
     if hline:
         bol = '\\hline '
 
-    ret = _tabular_row(A[0])
-    for x in A[1:]:
-        ret += eol
-        ret += bol + _tabular_row(x)
-    return ret
+    first = True
+    for x in A:
+        if not first:
+            yield eol + bol
+        first = False
+        yield _tabular_row(x)
 
 def _tabular_row(x):
-
-    ret = ''
-    ret += texstr(x[0])
-    for y in x[1:]:
-        ret += ' & ' + texstr(y)
-    return ret
+    return ' & '.join([texstr(y) for y in x])
     
 def tabular(A,spec='',hline=False):
+    return ''.join(iter_tabular(A,spec,hline))
+
+def iter_tabular(A,spec='',hline=False):
     if spec=='':
         spec = 'c'*len(A[0])
     top,bot = tabular_caps(spec)
-    mid = tabular_rows(A,hline)
-    return top + mid + bot
+    yield top
+    for chunk in iter_tabular_rows(A,hline):
+        yield chunk
+    yield bot
 
 def table_caps(sizestr=''):
     if sizestr!='':
@@ -103,25 +117,29 @@ def tikz_drawfill_plot(x,y,color='black!30',plot_opts=['']):
     return ret
 
 def tikz_plot(x,y,plot_opts=['']):
+    return ''.join(iter_tikz_plot(x,y,plot_opts))
+
+def iter_tikz_plot(x,y,plot_opts=['']):
     arg = '[' + _string_list_to_csv_string(plot_opts) + ']'
-    ret = 'plot' + arg + ' coordinates{'
+    yield 'plot' + arg + ' coordinates{'
     for pt in zip(x,y):
-        ret+=str(pt)
-    ret += '}'
-    return ret
+        yield str(pt)
+    yield '}'
 
     
-def tikz_segmented_fill_plot(x,Y,color='blue',plot_opts=['']):
+def tikz_segmented_fill_plot(x,Y,color='blue',plot_opts=[''],max_points=None):
     #create a segmented plot of the data in the rows of Y.  There will be a line
     # plot with the area under it filled proportionally according to the values 
     # in the rows of Y.  The segments are ordered top to bottom the same as the rows
     # of y.  The values in the single list x should contain the (common) x coordinates 
-    # of the data in Y (i.e. len(x) = len(Y[0])
+    # of the data in Y (i.e. len(x) = len(Y[0]).  If max_points is given the data
+    # is reduced with decimate()
 
-    Yc = copy.copy(Y)
+    x,Y = decimate(x,Y,max_points)
+    Yc = [list(y) for y in Y]
     m = len(Yc)
     n = len(Yc[0])
-    x= [x[0]] + x + [x[-1]]
+    x= [x[0]] + list(x) + [x[-1]]
     for ii in range(m-2,-1,-1): #may Yc a cumulative version of Y and plot each row
         for jj in range(n):
             Yc[ii][jj] += Yc[ii+1][jj]
@@ -135,36 +153,117 @@ def tikz_segmented_fill_plot(x,Y,color='blue',plot_opts=['']):
     return ret
     
 def pgf_addplot_coordinates(x,y,plot_opts=[''],closed=False):
+    return ''.join(iter_pgf_addplot_coordinates(x,y,plot_opts,closed))
+
+def iter_pgf_addplot_coordinates(x,y,plot_opts=[''],closed=False):
     if plot_opts==['']:
-        ret = '\\addplot coordinates {'
+        yield '\\addplot coordinates {'
     else:
-        ret = '\\addplot ' + '[' + _string_list_to_csv_string(plot_opts) + '] coordinates {'
+        yield '\\addplot ' + '[' + _string_list_to_csv_string(plot_opts) + '] coordinates {'
     for pt in zip(x,y):
-        ret += str(pt) +'\n'
-    ret += '}'
+        yield str(pt) +'\n'
     if closed:
-        ret += '\\closedcycle'
-    ret += ';'
-    return ret
+        yield '}\\closedcycle;'
+    else:
+        yield '};'
 
 def pgf_axis_caps(axis_opts=['']):
     top='\\begin{axis}[' + _string_list_to_csv_string(axis_opts) + ']\n'
     return top,'\\end{axis}'
 
-def pgf_stacked_area_plot(x,Y,legend=[],yrange=[],axis_opts=['']):
-    axis_opts += ['stack plots=y','area style']
+def pgf_stacked_area_plot(x,Y,legend=[],yrange=[],axis_opts=[''],max_points=None):
+    return ''.join(iter_pgf_stacked_area_plot(x,Y,legend,yrange,axis_opts,max_points))
+
+def iter_pgf_stacked_area_plot(x,Y,legend=[],yrange=[],axis_opts=[''],max_points=None):
+    #if max_points is given the data is reduced with decimate()
+    x,Y = decimate(x,Y,max_points)
+    axis_opts = axis_opts + ['stack plots=y','area style']
     if yrange!=[]:
         axis_opts += ['ymin='+str(yrange[0]),'ymax='+str(yrange[1])]
     top,bot = pgf_axis_caps(axis_opts)
-    ret = pgf_addplot_coordinates(x, Y[0],[''],True)
-    for ii in range(1,len(Y)):
+    yield top
+    for ii in range(len(Y)):
         #this_color = color + '!' + str(70*(m-ii)/m)
-        ret += '\n' + pgf_addplot_coordinates(x,Y[ii],[''],True)
+        if ii > 0:
+            yield '\n'
+        for chunk in iter_pgf_addplot_coordinates(x,Y[ii],[''],True):
+            yield chunk
 
     if legend != []:
-        ret += '\\legend{' + _string_list_to_csv_string(legend) + '}\n'
-    return top + ret + bot
+        yield '\\legend{' + _string_list_to_csv_string(legend) + '}\n'
+    yield bot
+
+
+def decimate(x,Y,max_points,method='lttb'):
+    #reduce the series in the rows of Y, with common x coordinates x, to at most max_points
+    # points.  The same points are kept in every row, so stacked plots stay consistent.
+    # Returns x,Y unchanged if max_points is None or there are few enough points.
+    #
+    # method='lttb' keeps one point per bucket, chosen by largest-triangle-three-buckets
+    #  on the stacked total.  method='minmax' keeps the minimum and maximum of each row
+    #  (or of the total, if max_points is too small for that) in each bucket.  Both keep
+    #  the first and last point.
+    n = len(x)
+    if max_points is None or n <= max_points:
+        return x,Y
+    if max_points < 3:
+        raise ValueError('max_points must be at least 3')
+
+    total = [sum(col) for col in zip(*Y)]
+    if method == 'lttb':
+        idx = _lttb_indices(x,total,max_points)
+    elif method == 'minmax':
+        if max_points < 4:
+            raise ValueError('max_points must be at least 4 for minmax decimation')
+        rows = Y
+        if 2 + 2*len(Y) > max_points:
+            rows = [total]
+        idx = _minmax_indices(rows,max_points)
+    else:
+        raise ValueError('Decimation method ' + str(method) + ' is unknown')
+    return [x[ii] for ii in idx], [[y[ii] for ii in idx] for y in Y]
+
+def _buckets(n,num_buckets):
+    #split the indices 1..n-2 into num_buckets consecutive ranges
+    size = float(n-2)/num_buckets
+    return [(1+int(k*size), 1+int((k+1)*size)) for k in range(num_buckets)]
+
+def _lttb_indices(x,y,max_points):
+    #indices chosen by largest-triangle-three-buckets
+    n = len(x)
+    buckets = _buckets(n,max_points-2)
+    idx = [0]
+    for k,(lo,hi) in enumerate(buckets):
+        #average of the next bucket (the last point after the last bucket)
+        if k+1 < len(buckets):
+            nlo,nhi = buckets[k+1]
+        else:
+            nlo,nhi = n-1,n
+        ax = float(sum(x[nlo:nhi]))/(nhi-nlo)
+        ay = float(sum(y[nlo:nhi]))/(nhi-nlo)
+
+        px,py = x[idx[-1]],y[idx[-1]]
+        best,best_area = lo,-1.0
+        for ii in range(lo,hi):
+            area = abs((px-ax)*(y[ii]-py) - (px-x[ii])*(ay-py))
+            if area > best_area:
+                best,best_area = ii,area
+        idx += [best]
+    return idx + [n-1]
 
+def _minmax_indices(rows,max_points):
+    #indices of the minimum and maximum of each row in each bucket
+    n = len(rows[0])
+    num_buckets = (max_points-2)//(2*len(rows))
+    idx = set([0,n-1])
+    for lo,hi in _buckets(n,num_buckets):
+        if hi <= lo:  #empty bucket
+            continue
+        for y in rows:
+            seg = y[lo:hi]
+            idx.add(lo + seg.index(min(seg)))
+            idx.add(lo + seg.index(max(seg)))
+    return sorted(idx)
 
 def _string_list_to_csv_string(x):
     #convert a list of strings into a comma separated string
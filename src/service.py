@@ -0,0 +1,240 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+
+# List of classes
+#
+# Allocation - an immutable snapshot of the allocation served to readers
+#
+# ExchangeService - re-optimize an AdExchange as change events arrive
+#
+# list of functions
+#
+# serve(service, host, port): accept JSON line events over TCP
+#
+# usage: python service.py [--port 8765] [--latency 0.05]
+#
+# An event is a dictionary with a type and, except end_day, the id of a participant:
+#
+#   {'type': 'ads_per_day', 'id': 4, 'value': 12}
+#   {'type': 'prefered', 'id': 4, 'value': [2, 7]}   prefered publishers
+#   {'type': 'excluded', 'id': 7, 'value': [4]}      excluded advertisers (publishers)
+#   {'type': 'pubs', 'id': 7, 'value': 40}           ads published per day (publishers)
+#   {'type': 'add', 'id': 12, 'participant': {...}}  keyword arguments of add_participant
+#   {'type': 'remove', 'id': 4}
+#   {'type': 'end_day'}                              solve and update the balances
+#
+# The first event of a burst starts a timer of latency seconds, the events that arrive
+# before it expires are applied together and today's allocation is solved once.  The
+# events and the solve run in a worker thread, one batch at a time, so the event loop
+# keeps accepting events and readers get the latest snapshot without waiting.
+
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+import json
+import timeit
+import numpy
+import advertiser
+
+Allocation = collections.namedtuple('Allocation', ['version', 'day', 'flow', 'objective', 'events'])
+# version - number of solves, day - days solved, flow - read-only array of the ads on each
+#  edge, objective - its value, events - number of events applied so far
+
+_updates = {'ads_per_day': 'ads_per_day', 'prefered': 'prefered_pub_ids', 'excluded': 'excl_ad_ids', 'pubs': 'pubs'}
+
+class ExchangeService(object):
+    # Apply change events to an AdExchange and keep an Allocation of today's problem.
+    #  The exchange must not be used by others while the service runs.
+
+    def __init__(self, adex, latency=0.05):
+        self.adex = adex
+        self.latency = latency
+        self.solve_seconds = 0.0 #wall time of the solves
+        self.errors = []         #(event action, participant id, message) of the failed events and solves
+        self._queue = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._events = 0
+        self._version = 0
+        self._snapshot = None
+        self._publish()
+
+    def snapshot(self):
+        #the latest Allocation
+        return self._snapshot
+
+    async def submit(self, event):
+        #queue a change event
+        _check(event)
+        await self._get_queue().put(event)
+
+    def submit_nowait(self, event):
+        _check(event)
+        self._get_queue().put_nowait(event)
+
+    def _get_queue(self):
+        #the queue is created in the running event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def run(self):
+        #apply the events in bursts until cancelled
+        queue = self._get_queue()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                batch = [await queue.get()]
+                deadline = loop.time() + self.latency
+                while True:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch += [await asyncio.wait_for(queue.get(), timeout)]
+                    except asyncio.TimeoutError:
+                        break
+                while not queue.empty():
+                    batch += [queue.get_nowait()]
+                try:
+                    await loop.run_in_executor(self._executor, self._apply, batch)
+                except Exception as err:
+                    self.errors.append(('batch', None, str(err)))
+        finally:
+            self._executor.shutdown(wait=False)
+
+    def _apply(self, batch):
+        #apply a batch of events and solve today's problem once, in the worker thread.  A
+        # failed event or solve is recorded in errors and the others go on, so the service
+        # keeps running
+        adex = self.adex
+        changed = False
+        for action,a_id,kwargs in coalesce(batch):
+            if action == 'end_day':
+                if self._timed(action, adex.update):
+                    changed = False
+                continue
+            try:
+                if action == 'update':
+                    adex.update_participant(a_id, **kwargs)
+                elif action == 'add':
+                    adex.add_participant(a_id, **kwargs)
+                else:
+                    adex.remove_participant(a_id)
+            except Exception as err:
+                self.errors.append((action, a_id, str(err)))
+                continue
+            changed = True
+        if changed:
+            self._timed('solve', self._resolve)
+        self._events += len(batch)
+        self._publish()
+
+    def _timed(self, action, f):
+        #call f, return True if it succeeded.  A failure is recorded in errors
+        start = timeit.default_timer()
+        try:
+            f()
+        except Exception as err:
+            self.errors.append((action, None, str(err)))
+            return False
+        finally:
+            self.solve_seconds += timeit.default_timer() - start
+        self._version += 1
+        return True
+
+    def _resolve(self):
+        #solve today's problem without finishing the day
+        self.adex._set_constraints()
+        self.adex._flow = self.adex._solve()
+
+    def _publish(self):
+        #replace the snapshot, readers holding the old one are not affected
+        flow = numpy.array(self.adex._flow, dtype=int)
+        flow.setflags(write=False)
+        objective = float(numpy.dot(self.adex._edge_weights, flow))
+        self._snapshot = Allocation(self._version, self.adex._day, flow, objective, self._events)
+
+def _check(event):
+    #raise ValueError unless event is a valid event
+    t = event.get('type')
+    if t not in _updates and t not in ['add', 'remove', 'end_day']:
+        raise ValueError('Event type ' + str(t) + ' is unknown')
+    if t != 'end_day' and 'id' not in event:
+        raise ValueError('Event ' + str(t) + ' needs the id of a participant')
+    if t in _updates and 'value' not in event:
+        raise ValueError('Event ' + str(t) + ' needs a value')
+    if t == 'add' and not isinstance(event.get('participant'), dict):
+        raise ValueError('Event add needs the participant as a dictionary')
+
+def coalesce(events):
+    #list of (action, participant id, keyword arguments) for a list of events.  The
+    # updates of a participant between two add, remove or end_day events are merged
+    # into one update, later values win
+    actions = []
+    pending = collections.OrderedDict()
+
+    def flush():
+        for a_id,kwargs in pending.items():
+            actions.append(('update', a_id, kwargs))
+        pending.clear()
+
+    for e in events:
+        t = e['type']
+        if t in _updates:
+            pending.setdefault(e['id'], {})[_updates[t]] = e['value']
+        elif t == 'add':
+            flush()
+            actions.append(('add', e['id'], dict(e['participant'])))
+        elif t == 'remove':
+            flush()
+            actions.append(('remove', e['id'], {}))
+        elif t == 'end_day':
+            flush()
+            actions.append(('end_day', None, {}))
+        else:
+            raise ValueError('Event type ' + str(t) + ' is unknown')
+    flush()
+    return actions
+
+async def serve(service, host='127.0.0.1', port=8765):
+    #accept one JSON event per line.  A line {"type": "snapshot"} is answered with the
+    # version, day, objective, events and total ads of the latest snapshot
+    async def handle(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                event = json.loads(line.decode('utf-8'))
+                if event.get('type') == 'snapshot':
+                    s = service.snapshot()
+                    reply = {'version': s.version, 'day': s.day, 'objective': s.objective,
+                             'events': s.events, 'total_ads': int(s.flow.sum())}
+                else:
+                    await service.submit(event)
+                    reply = {'queued': True}
+            except (ValueError, KeyError, TypeError) as err:
+                reply = {'error': str(err)}
+            writer.write((json.dumps(reply) + '\n').encode('utf-8'))
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await asyncio.gather(server.serve_forever(), service.run())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the sample exchange, one JSON event per line')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds to collect a burst of events')
+    parser.add_argument('--solver', default=None)
+    args = parser.parse_args(argv)
+    adex = advertiser.AdExchange.from_sample_data(True, args.solver)
+    asyncio.run(serve(ExchangeService(adex, args.latency), args.host, args.port))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1070 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+
+# List of classes
+#
+# Solver - interface between an AdExchange and the optimizer for the daily problem
+#
+# GurobiSolver - solve the daily problem as a linear program with Gurobi Optimizer
+#
+# FlowSolver - solve the daily problem as a linear program with scipy's HiGHS interface
+#
+# ComponentSolver - split the daily problem into connected components, solved concurrently
+#
+# GreedySolver - approximate the daily problem by filling edges in order of weight
+#
+# AggregateSolver - solve a smaller problem on classes of equivalent nodes
+#
+# The daily problem is a bipartite transportation problem.  Nodes 0..n-1 are the
+# businesses in the exchange and edge k carries ads from advertiser tails[k] to
+# publisher heads[k], with weight weights[k] and capacity caps[k].  Each day node i
+# may place at most ads_cap[i] ads and publish at most pubs_cap[i] ads.  A solver
+# returns the number of ads on each edge.  The constraints are stored once, as a
+# sparse incidence matrix built from the edge list.
+
+import numpy
+import scipy.optimize
+import scipy.sparse
+import scipy.sparse.csgraph
+import multiprocessing.pool
+import copy
+import os
+import collections
+
+try:
+    import gurobipy
+except ImportError:
+    gurobipy = None
+
+def make_solver(solver=None, name='AdExchange', quiet=False):
+    # return a Solver instance.  solver may be a Solver, 'gurobi', 'flow', 'greedy', 'components'
+    #  (ComponentSolver of the default solver), 'aggregate' (AggregateSolver of the default solver) or None for the default (Gurobi if gurobipy is installed, otherwise the min-cost flow solver)
+    if isinstance(solver, Solver):
+        return solver
+    if solver is None:
+        solver = _default_kind()
+    if solver == 'gurobi':
+        return GurobiSolver(name, quiet)
+    if solver == 'flow':
+        return FlowSolver()
+    if solver == 'components':
+        return ComponentSolver(None, name, quiet)
+    if solver == 'greedy':
+        return GreedySolver()
+    if solver == 'aggregate':
+        return AggregateSolver(None, name, quiet)
+    raise ValueError('Solver ' + str(solver) + ' is unknown')
+
+def _default_kind():
+    #the kind of solver made for None
+    if gurobipy is None:
+        return 'flow'
+    return 'gurobi'
+
+def solver_from_settings(settings, name='AdExchange', quiet=False):
+    # return a new Solver from a dictionary returned by Solver.settings()
+    kind = settings.get('solver')
+    if kind == 'gurobi':
+        return GurobiSolver(name, quiet, settings.get('incremental', False))
+    if kind == 'flow':
+        return FlowSolver()
+    if kind == 'greedy':
+        return GreedySolver(settings.get('rounds', 2))
+    inner = settings.get('inner')
+    if kind == 'components':
+        return ComponentSolver(inner, name, quiet, settings.get('threads'))
+    if kind == 'aggregate':
+        return AggregateSolver(inner, name, quiet)
+    return make_solver(kind, name, quiet)
+
+def _new_solver(solver, name, quiet):
+    #a new solver for the solver argument of ComponentSolver and AggregateSolver: a
+    # function returning a Solver, a settings dictionary or an argument of make_solver()
+    if isinstance(solver, dict):
+        return solver_from_settings(solver, name, quiet)
+    if callable(solver) and not isinstance(solver, Solver):
+        return solver()
+    return make_solver(solver, name, quiet)
+
+def _inner_settings(solver, subs):
+    #the settings of the solvers made by _new_solver() from solver.  A function is only
+    # called if there is no solver it made in the list subs
+    if isinstance(solver, dict):
+        return solver
+    if isinstance(solver, Solver):
+        return solver.settings()
+    if callable(solver):
+        if len(subs) > 0:
+            return subs[0].settings()
+        return solver().settings()
+    return {'solver': solver or _default_kind()}
+
+def _fresh(solver):
+    #an argument of make_solver() for a new solver, a Solver instance is not shared
+    if isinstance(solver, Solver):
+        return solver.fresh()
+    return solver
+
+class Solver:
+    # Base class for the daily problem solvers
+
+    num_nodes = 0
+    tails = []
+    heads = []
+    weights = []
+    caps = []
+    iterations = None #simplex iterations of the last solve, None if not counted
+    bound = None      #upper bound on the objective of the last solve, None for exact solvers
+    _incidence = None   #see incidence, None until it is first used after a change
+    _constr_rows = None #see constr_rows
+
+    def build(self, num_nodes, tails, heads, weights, caps, labels=None):
+        #store the structure of the problem, labels optionally names each node
+        self.num_nodes = num_nodes
+        self.tails = numpy.asarray(tails, dtype=int)
+        self.heads = numpy.asarray(heads, dtype=int)
+        self.weights = numpy.asarray(weights, dtype=float)
+        self.caps = numpy.asarray(caps, dtype=int)
+        self._incidence = None
+        self._constr_rows = None
+
+    @property
+    def incidence(self):
+        #2n x m sparse matrix, row i (n+j) sums the ads placed by i (published by j)
+        if self._incidence is None:
+            n = self.num_nodes
+            m = len(self.tails)
+            rows = numpy.concatenate([self.tails, self.heads + n])
+            cols = numpy.concatenate([numpy.arange(m), numpy.arange(m)])
+            self._incidence = scipy.sparse.csr_matrix((numpy.ones(2*m), (rows, cols)), shape=(2*n, m))
+        return self._incidence
+
+    @property
+    def constr_rows(self):
+        #rows of incidence that are constraints, empty publishing rows are dropped
+        if self._constr_rows is None:
+            n = self.num_nodes
+            has_pubs = numpy.bincount(self.heads, minlength=n) > 0
+            self._constr_rows = numpy.concatenate([numpy.arange(n), n + numpy.nonzero(has_pubs)[0]])
+        return self._constr_rows
+
+    # Changes to a built problem.  The edge arrays are replaced rather than changed in
+    #  place, copies of a solver share them.  An edge is retired by setting its capacity
+    #  to 0, so the edge indices never change.  incidence and constr_rows are rebuilt
+    #  when they are next used, so a burst of changes costs one rebuild.
+
+    def add_nodes(self, labels):
+        #add one node without edges for each label
+        self.num_nodes += len(labels)
+        self._incidence = None
+        self._constr_rows = None
+
+    def add_edges(self, tails, heads, weights, caps):
+        #append edges, a (tail, head) pair may appear only once
+        self.tails = numpy.concatenate([self.tails, numpy.asarray(tails, dtype=int)])
+        self.heads = numpy.concatenate([self.heads, numpy.asarray(heads, dtype=int)])
+        self.weights = numpy.concatenate([self.weights, numpy.asarray(weights, dtype=float)])
+        self.caps = numpy.concatenate([self.caps, numpy.asarray(caps, dtype=int)])
+        self._incidence = None
+        self._constr_rows = None
+
+    def update_edges(self, edges, weights, caps):
+        #change the weight and capacity of the edges with the given indices
+        self.weights = self.weights.copy()
+        self.weights[edges] = weights
+        self.caps = self.caps.copy()
+        self.caps[edges] = caps
+
+    def rhs(self, ads_cap, pubs_cap):
+        #right hand side for the rows constr_rows of incidence
+        return numpy.concatenate([numpy.asarray(ads_cap), numpy.asarray(pubs_cap)])[self.constr_rows]
+
+    def solve(self, ads_cap, pubs_cap):
+        #return a numpy array with the (integral) number of ads on each edge
+        raise NotImplementedError
+
+    def copy(self):
+        #return an independent copy of the solver
+        return copy.copy(self)
+
+    def _isolate(self):
+        #prepare the solver, before build(), to be solved in one thread while other
+        # solvers are solved in other threads
+        pass
+
+    def settings(self):
+        #dictionary of the kind and settings of the solver, see solver_from_settings()
+        return {'solver': None}
+
+    def fresh(self):
+        #return a new solver with the same settings, without a problem
+        return solver_from_settings(self.settings())
+
+class GurobiSolver(Solver):
+    # Solve the linear programming relaxation with Gurobi Optimizer.  The constraint
+    #  matrix is totally unimodular so the optimal basic solution is integral.  The
+    #  variables and constraints are added with the matrix API (Gurobi 10 or later),
+    #  the constraint matrix is the incidence matrix restricted to constr_rows.
+    #
+    # By default the constraints are removed and rebuilt every day.  In incremental mode
+    #  the constraints are created once by build() and each day only the right hand sides
+    #  that changed are updated in place.  The model keeps the previous day's basis, which
+    #  stays dual feasible after a change of right hand side, so dual simplex re-solves
+    #  from there instead of from scratch.
+    #
+    # Added nodes and edges become new variables and constraints of the existing model,
+    #  an edge is retired by setting its upper bound to 0.
+
+    incremental = False
+    _name = 'AdExchange'
+    _quiet = False
+    _model = []
+    _env = None     #gurobipy.Env of the model, None for the default environment
+    _x = None       #MVar of edge variables
+    _constr = None  #MConstr of advertising and publishing constraints
+    _constr_names = None #names of the constraints, None until they are next needed
+    _labels = []
+    _rhs = None     #current right hand side of _constr
+    _new_x = []     #variables added since the last _flush()
+    _pending = None #(ads, pubs) constraint dictionaries of nodes changed since the last _flush()
+
+    def __init__(self, name='AdExchange', quiet=False, incremental=False):
+        if gurobipy is None:
+            raise ImportError('gurobipy is required for the gurobi solver')
+        self.incremental = incremental
+        self._name = name
+        self._quiet = quiet
+        self._env = None
+        self._model = self._new_model()
+        self._x = None
+        self._constr = None
+        self._constr_names = None
+        self._labels = []
+        self._rhs = None
+        self._new_x = []
+        self._pending = None
+
+    def _new_model(self):
+        model = gurobipy.Model(self._name, env=self._env)
+        model.ModelSense = gurobipy.GRB.MAXIMIZE
+        if self._quiet:
+            model.setParam('OutputFlag',0)
+        if self.incremental:
+            model.setParam('Method',1) #dual simplex
+        return model
+
+    def _isolate(self):
+        #Gurobi does not optimize models of one environment in several threads at once,
+        # the model moves to an environment of its own
+        if self._env is None and self._x is None:
+            self._env = gurobipy.Env(empty=True)
+            if self._quiet:
+                self._env.setParam('OutputFlag',0)
+            self._env.start()
+            self._model = self._new_model()
+
+    def build(self, num_nodes, tails, heads, weights, caps, labels=None):
+        Solver.build(self, num_nodes, tails, heads, weights, caps)
+        if labels is None:
+            labels = [str(ii) for ii in range(num_nodes)]
+        self._labels = list(labels)
+        self._constr_names = None
+
+        #add a variable for each edge in one call, the weights define the objective function
+        names = [labels[t] + '->' + labels[h] for t,h in zip(self.tails.tolist(), self.heads.tolist())]
+        self._x = self._model.addMVar(len(self.tails), lb=0.0, ub=self.caps, obj=self.weights, name=names)
+        #tell the model to incorporate the edges
+        self._model.update()
+
+        if self.incremental:
+            #constraints with placeholder right hand sides, set by the first solve()
+            self._set_constraints(numpy.zeros(len(self.constr_rows)))
+            self._rhs = None
+
+    def _name_constraints(self):
+        n = self.num_nodes
+        self._constr_names = [self._labels[ii] + ' ads' for ii in range(n)] + \
+                             [self._labels[ii - n] + ' pubs' for ii in self.constr_rows[n:].tolist()]
+
+    def _node_constraints(self):
+        #dictionaries of the advertising and the publishing constraint of each node
+        if self._pending is not None:
+            return self._pending
+        n = self.num_nodes
+        ads = {}
+        pubs = {}
+        for r,c in zip(self.constr_rows.tolist(), self._constr.tolist()):
+            if r < n:
+                ads[r] = c
+            else:
+                pubs[r-n] = c
+        return ads,pubs
+
+    def _flush(self):
+        #put the variables and constraints added since the last call in the order of the
+        # edges and of constr_rows, all right hand sides are set by the next solve()
+        if len(self._new_x) > 0:
+            self._x = gurobipy.MVar.fromlist(self._x.tolist() + self._new_x)
+            self._new_x = []
+        if self._pending is not None:
+            ads,pubs = self._pending
+            n = self.num_nodes
+            self._constr = gurobipy.MConstr.fromlist([ads[r] if r < n else pubs[r-n] for r in self.constr_rows.tolist()])
+            self._pending = None
+            self._rhs = None
+
+    # Changes are added to the model as they come, the lists of variables and constraints
+    #  are put in order once, by _flush() before the next solve
+
+    def add_nodes(self, labels):
+        edit = self.incremental and self._constr is not None
+        if edit:
+            ads,pubs = self._node_constraints()
+        Solver.add_nodes(self, labels)
+        self._labels = self._labels + list(labels)
+        self._constr_names = None
+        if edit:
+            for ii in range(self.num_nodes - len(labels), self.num_nodes):
+                ads[ii] = self._model.addLConstr(gurobipy.LinExpr(), gurobipy.GRB.LESS_EQUAL, 0.0, name=self._labels[ii] + ' ads')
+            self._model.update()
+            self._pending = (ads,pubs)
+
+    def add_edges(self, tails, heads, weights, caps):
+        edit = self.incremental and self._constr is not None
+        if edit:
+            ads,pubs = self._node_constraints()
+        Solver.add_edges(self, tails, heads, weights, caps)
+        self._constr_names = None
+
+        new = []
+        for t,h,w,u in zip(numpy.asarray(tails).tolist(), numpy.asarray(heads).tolist(), numpy.asarray(weights).tolist(), numpy.asarray(caps).tolist()):
+            column = None
+            if edit:
+                #the new variable appears in the constraints of its advertiser and publisher
+                if h not in pubs:
+                    pubs[h] = self._model.addLConstr(gurobipy.LinExpr(), gurobipy.GRB.LESS_EQUAL, 0.0, name=self._labels[h] + ' pubs')
+                column = gurobipy.Column([1.0, 1.0], [ads[t], pubs[h]])
+            new += [self._model.addVar(lb=0.0, ub=u, obj=w, name=self._labels[t] + '->' + self._labels[h], column=column)]
+        self._model.update()
+        self._new_x = self._new_x + new
+        if edit:
+            self._pending = (ads,pubs)
+
+    def update_edges(self, edges, weights, caps):
+        Solver.update_edges(self, edges, weights, caps)
+        edges = numpy.asarray(edges, dtype=int)
+        if len(edges) > 0 and edges.max() >= self._x.shape[0]:
+            self._flush()
+        x = self._x[edges]
+        x.Obj = numpy.asarray(weights, dtype=float)
+        x.UB = numpy.asarray(caps, dtype=float)
+        self._model.update()
+
+    def solve(self, ads_cap, pubs_cap):
+        self._flush()
+        rhs = self.rhs(ads_cap, pubs_cap)
+        if self.incremental:
+            self._update_rhs(rhs)
+        else:
+            self._set_constraints(rhs)
+        self._model.optimize()
+        self.iterations = int(self._model.IterCount)
+        return self._x.X.astype(int) #will round down
+
+    def _set_constraints(self, rhs):
+        #remove any old constraints and add the advertising and publishing constraints
+        if self._constr is not None:
+            self._model.remove(self._constr)
+        if self._constr_names is None:
+            self._name_constraints()
+        self._constr = self._model.addMConstr(self.incidence[self.constr_rows], self._x, gurobipy.GRB.LESS_EQUAL, rhs, name=self._constr_names)
+        self._model.update()
+        self._rhs = rhs
+
+    def _update_rhs(self, rhs):
+        #change the right hand side of the constraints whose value changed since the last solve
+        if self._rhs is None:
+            changed = numpy.arange(len(rhs))
+        else:
+            changed = numpy.nonzero(rhs != self._rhs)[0]
+        if len(changed) > 0:
+            self._constr[changed].RHS = rhs[changed]
+            self._model.update()
+        self._rhs = rhs
+
+    def settings(self):
+        return {'solver': 'gurobi', 'incremental': self.incremental}
+
+    def fresh(self):
+        return GurobiSolver(self._name, self._quiet, self.incremental)
+
+    def copy(self):
+        self._flush()
+        cpy = Solver.copy(self)
+        cpy._model = self._model.copy()
+        x = cpy._model.getVars()
+        cpy._x = gurobipy.MVar.fromlist([x[v.index] for v in self._x.tolist()])
+        if self._constr is not None:
+            constrs = cpy._model.getConstrs()
+            cpy._constr = gurobipy.MConstr.fromlist([constrs[c.index] for c in self._constr.tolist()])
+        return cpy
+
+class FlowSolver(Solver):
+    # Solve the daily problem, a min-cost flow (transportation) problem, as a linear
+    #  program with scipy's HiGHS interface.  No license is needed.  The constraint
+    #  matrix is totally unimodular and dual simplex returns a basic solution, so the
+    #  flows are integral up to rounding.
+    #
+    # The constraint matrix and the bounds are kept until the edges change, each solve
+    #  only sets the right hand side.
+
+    _matrix = None  #incidence restricted to constr_rows, None after a change
+    _bounds = None  #(lower, upper) bounds of the edge variables
+
+    def __init__(self):
+        self._matrix = None
+        self._bounds = None
+
+    def build(self, num_nodes, tails, heads, weights, caps, labels=None):
+        Solver.build(self, num_nodes, tails, heads, weights, caps)
+        self._matrix = None
+
+    def add_nodes(self, labels):
+        Solver.add_nodes(self, labels)
+        self._matrix = None
+
+    def add_edges(self, tails, heads, weights, caps):
+        Solver.add_edges(self, tails, heads, weights, caps)
+        self._matrix = None
+
+    def update_edges(self, edges, weights, caps):
+        Solver.update_edges(self, edges, weights, caps)
+        self._bounds = None
+
+    def solve(self, ads_cap, pubs_cap):
+        if len(self.tails) == 0:
+            self.iterations = 0
+            return numpy.zeros(0, dtype=int)
+        if self._matrix is None:
+            self._matrix = self.incidence[self.constr_rows]
+            self._bounds = None
+        if self._bounds is None:
+            self._bounds = numpy.stack([numpy.zeros(len(self.caps)), self.caps], axis=1)
+        rhs = self.rhs(numpy.maximum(0, ads_cap), numpy.maximum(0, pubs_cap))
+        res = scipy.optimize.linprog(-self.weights, A_ub=self._matrix, b_ub=rhs, bounds=self._bounds, method='highs-ds')
+        if not res.success:
+            raise RuntimeError('Daily problem not solved: ' + res.message)
+        self.iterations = int(res.nit)
+        return numpy.round(res.x).astype(int)
+
+    def settings(self):
+        return {'solver': 'flow'}
+
+    def fresh(self):
+        return FlowSolver()
+
+_pools = {} #thread pool of each (process, number of threads), shared by the ComponentSolvers
+
+def _thread_pool(threads):
+    #the shared thread pool with threads threads (None for one per cpu) of this process,
+    # a forked worker process creates its own
+    key = (os.getpid(), threads)
+    if key not in _pools:
+        _pools[key] = multiprocessing.pool.ThreadPool(threads)
+    return _pools[key]
+
+class ComponentSolver(Solver):
+    # Split the daily problem into the connected components of the advertiser->publisher
+    #  graph and solve each one with its own solver.  The components are solved
+    #  concurrently in a thread pool, which runs in parallel for solvers that release the
+    #  interpreter lock while they optimize (Gurobi).  Each component's solver is
+    #  isolated (see Solver._isolate()), so each Gurobi model has an environment of its
+    #  own.  The pool is shared by every ComponentSolver with the same number of
+    #  threads, so copies do not add threads.  The flows are merged back in the original
+    #  edge order.
+    #
+    # solver is passed to make_solver() for each component, or is a settings dictionary
+    #  (see solver_from_settings()) or a function returning a new Solver.  A business can be in two components, once as advertiser and once as
+    #  publisher.
+    #
+    # Added edges join the components they touch.  Edges that touch one component are
+    #  added to its solver, edges that connect several components rebuild only the merged
+    #  component.  Changes of existing edges are passed to the solver of their component.
+
+    threads = None
+    _solver = None
+    _name = 'AdExchange'
+    _quiet = False
+    _components = []  #(nodes, edges, solver) of each component, None once merged into another
+    _edge_component = [] #component of each edge
+    _ad_comp = []     #component of each node as advertiser, -1 without edges
+    _ad_local = []    #node number of each node in its advertiser component
+    _pub_comp = []    #component of each node as publisher, -1 without edges
+    _pub_local = []   #node number of each node in its publisher component
+    _labels = None
+
+    def __init__(self, solver=None, name='AdExchange', quiet=False, threads=None):
+        self._solver = solver
+        self._name = name
+        self._quiet = quiet
+        self.threads = threads
+        self._components = []
+        self._edge_component = []
+        self._labels = None
+
+    def _new_solver(self):
+        #the components are solved concurrently, each solver is isolated
+        sub = _new_solver(self._solver, self._name, self._quiet)
+        sub._isolate()
+        return sub
+
+    def _sub_labels(self, nodes):
+        if self._labels is None:
+            return None
+        return [self._labels[ii] for ii in nodes]
+
+    def build(self, num_nodes, tails, heads, weights, caps, labels=None):
+        Solver.build(self, num_nodes, tails, heads, weights, caps)
+        self._labels = labels
+
+        #advertiser i is vertex i and publisher j is vertex num_nodes+j
+        m = len(self.tails)
+        adj = scipy.sparse.csr_matrix((numpy.ones(m), (self.tails, self.heads + num_nodes)), shape=(2*num_nodes, 2*num_nodes))
+        num_comp,comp = scipy.sparse.csgraph.connected_components(adj, directed=False)
+
+        self._components = []
+        self._edge_component = numpy.zeros(m, dtype=int)
+        self._ad_comp = numpy.zeros(num_nodes, dtype=int) - 1
+        self._ad_local = numpy.zeros(num_nodes, dtype=int)
+        self._pub_comp = numpy.zeros(num_nodes, dtype=int) - 1
+        self._pub_local = numpy.zeros(num_nodes, dtype=int)
+        edge_comp = comp[self.tails]
+        order = numpy.argsort(edge_comp, kind='mergesort')
+        bounds = numpy.searchsorted(edge_comp[order], numpy.arange(num_comp+1))
+        for c in range(num_comp):
+            edges = order[bounds[c]:bounds[c+1]]
+            if len(edges) > 0:
+                self._components += [None]
+                self._set_component(len(self._components)-1, edges)
+
+    def _set_component(self, c, edges):
+        #build component c from its edges, in increasing order
+        k = len(edges)
+        nodes,local = numpy.unique(numpy.concatenate([self.tails[edges], self.heads[edges]]), return_inverse=True)
+        local = local.reshape(-1)
+        sub = self._new_solver()
+        sub.build(len(nodes), local[:k], local[k:], self.weights[edges], self.caps[edges], self._sub_labels(nodes.tolist()))
+        self._assign(c, edges, local[:k], local[k:])
+        self._components[c] = (nodes, edges, sub)
+
+    def _assign(self, c, edges, local_tails, local_heads):
+        #record that edges, with the given node numbers, are in component c
+        self._edge_component[edges] = c
+        self._ad_comp[self.tails[edges]] = c
+        self._ad_local[self.tails[edges]] = local_tails
+        self._pub_comp[self.heads[edges]] = c
+        self._pub_local[self.heads[edges]] = local_heads
+
+    def add_nodes(self, labels):
+        Solver.add_nodes(self, labels)
+        if self._labels is not None:
+            self._labels = self._labels + list(labels)
+        #nodes without edges are in no component
+        none = numpy.zeros(len(labels), dtype=int)
+        self._ad_comp = numpy.concatenate([self._ad_comp, none - 1])
+        self._ad_local = numpy.concatenate([self._ad_local, none])
+        self._pub_comp = numpy.concatenate([self._pub_comp, none - 1])
+        self._pub_local = numpy.concatenate([self._pub_local, none])
+
+    def add_edges(self, tails, heads, weights, caps):
+        m = len(self.tails)
+        Solver.add_edges(self, tails, heads, weights, caps)
+        self._edge_component = numpy.concatenate([self._edge_component, numpy.zeros(len(self.tails) - m, dtype=int) - 1])
+
+        #union-find over the components and the new advertiser and publisher vertices
+        parent = {}
+        def find(x):
+            while parent.setdefault(x, x) != x:
+                x = parent[x]
+            return x
+        ends = []
+        for k in range(m, len(self.tails)):
+            t = int(self.tails[k])
+            h = int(self.heads[k])
+            a = ('c', int(self._ad_comp[t])) if self._ad_comp[t] >= 0 else ('a', t)
+            p = ('c', int(self._pub_comp[h])) if self._pub_comp[h] >= 0 else ('p', h)
+            parent[find(a)] = find(p)
+            ends += [(k, a, p)]
+        groups = collections.OrderedDict()
+        for k,a,p in ends:
+            edges,comps = groups.setdefault(find(a), ([], set()))
+            edges += [k]
+            comps.update([x[1] for x in [a,p] if x[0] == 'c'])
+
+        for edges,comps in groups.values():
+            edges = numpy.array(edges, dtype=int)
+            if len(comps) == 1:
+                self._extend(comps.pop(), edges)
+                continue
+            #a new component, or several components joined by the new edges
+            comps = sorted(comps)
+            for c in comps:
+                edges = numpy.concatenate([self._components[c][1], edges])
+                self._components[c] = None
+            if len(comps) == 0:
+                self._components += [None]
+                comps = [len(self._components)-1]
+            self._set_component(comps[0], numpy.sort(edges))
+
+    def _extend(self, c, edges):
+        #add edges, whose nodes are in component c or in no component, to component c
+        nodes,comp_edges,sub = self._components[c]
+        added = collections.OrderedDict() #node number of each node new to the component
+        local = []
+        for ii in numpy.concatenate([self.tails[edges], self.heads[edges]]).tolist():
+            if self._ad_comp[ii] == c:
+                local += [self._ad_local[ii]]
+            elif self._pub_comp[ii] == c:
+                local += [self._pub_local[ii]]
+            else:
+                local += [added.setdefault(ii, len(nodes) + len(added))]
+        local = numpy.array(local, dtype=int)
+        k = len(edges)
+        if len(added) > 0:
+            new = list(added)
+            sub.add_nodes(self._sub_labels(new) or [str(ii) for ii in new])
+            nodes = numpy.concatenate([nodes, numpy.array(new, dtype=int)])
+        sub.add_edges(local[:k], local[k:], self.weights[edges], self.caps[edges])
+        self._assign(c, edges, local[:k], local[k:])
+        self._components[c] = (nodes, numpy.concatenate([comp_edges, edges]), sub)
+
+    def update_edges(self, edges, weights, caps):
+        Solver.update_edges(self, edges, weights, caps)
+        edges = numpy.asarray(edges, dtype=int)
+        comp = self._edge_component[edges]
+        for c in numpy.unique(comp).tolist():
+            nodes,comp_edges,sub = self._components[c]
+            e = edges[comp == c]
+            #comp_edges is sorted, so the local index of an edge is its position
+            sub.update_edges(numpy.searchsorted(comp_edges, e), self.weights[e], self.caps[e])
+
+    def num_components(self):
+        return len([c for c in self._components if c is not None])
+
+    def solve(self, ads_cap, pubs_cap):
+        ads_cap = numpy.asarray(ads_cap)
+        pubs_cap = numpy.asarray(pubs_cap)
+        components = [c for c in self._components if c is not None]
+
+        def solve_component(component):
+            nodes,edges,sub = component
+            return sub.solve(ads_cap[nodes], pubs_cap[nodes])
+
+        if len(components) > 1:
+            results = _thread_pool(self.threads).map(solve_component, components)
+        else:
+            results = [solve_component(c) for c in components]
+
+        flow = numpy.zeros(len(self.tails), dtype=int)
+        for (nodes,edges,sub),x in zip(components, results):
+            flow[edges] = x
+
+        counts = [sub.iterations for nodes,edges,sub in components]
+        self.iterations = None
+        if None not in counts:
+            self.iterations = sum(counts)
+        bounds = [sub.bound for nodes,edges,sub in components]
+        self.bound = None
+        if len(bounds) > 0 and None not in bounds:
+            self.bound = sum(bounds)
+        return flow
+
+    def settings(self):
+        subs = [c[2] for c in self._components if c is not None]
+        return {'solver': 'components', 'inner': _inner_settings(self._solver, subs), 'threads': self.threads}
+
+    def fresh(self):
+        return ComponentSolver(_fresh(self._solver), self._name, self._quiet, self.threads)
+
+    def copy(self):
+        cpy = Solver.copy(self)
+        cpy._components = [c if c is None else (c[0], c[1], c[2].copy()) for c in self._components]
+        for col in ['_edge_component', '_ad_comp', '_ad_local', '_pub_comp', '_pub_local']:
+            setattr(cpy, col, numpy.array(getattr(self, col)))
+        return cpy
+
+class GreedySolver(Solver):
+    # Approximate the daily problem in one pass over the edges: in order of decreasing
+    #  weight each edge gets as many ads as its capacity and the remaining capacities of
+    #  its advertiser and publisher allow.
+    #
+    # The pass also gives a feasible solution of the dual linear program, stored as the
+    #  upper bound bound.  An advertiser (publisher) with no capacity left gets the dual
+    #  value u (v) of the edge that used it up, every later edge of that node has no
+    #  larger weight.  With z_k = max(0, w_k - u_t - v_h) every dual constraint
+    #  u_t + v_h + z_k >= w_k holds, and the bound is the dual objective.
+    #
+    # The bound is then tightened by rounds of coordinate descent.  For fixed v the dual
+    #  objective is a sum over the advertisers of the convex piecewise linear functions
+    #  ads_cap_t*u_t + sum_k caps_k*max(0, w_k - v_h - u_t), each minimized by sorting
+    #  the edges of t (see _dual_step()), then v is updated the same way for fixed u.
+    #  Every step keeps the duals feasible and does not increase the dual objective.  The
+    #  descent can stall at a corner, so it starts once from v = 0 and once from u = 0,
+    #  and bound is the smallest of the two and the greedy dual objective.
+
+    rounds = 2
+
+    def __init__(self, rounds=2):
+        self.rounds = rounds
+
+    def solve(self, ads_cap, pubs_cap):
+        ads_left = numpy.maximum(0, numpy.asarray(ads_cap, dtype=int)).tolist()
+        pubs_left = numpy.maximum(0, numpy.asarray(pubs_cap, dtype=int)).tolist()
+        #nodes without capacity block all of their edges at no cost in the dual objective
+        top = float(self.weights.max()) if len(self.weights) > 0 else 0.0
+        u = [top if a == 0 else 0.0 for a in ads_left]
+        v = [top if p == 0 else 0.0 for p in pubs_left]
+        flow = [0]*len(self.tails)
+
+        order = numpy.argsort(-self.weights, kind='mergesort')
+        tails = self.tails.tolist()
+        heads = self.heads.tolist()
+        weights = self.weights.tolist()
+        caps = self.caps.tolist()
+        for k in order.tolist():
+            t = tails[k]
+            h = heads[k]
+            x = min(caps[k], ads_left[t], pubs_left[h])
+            if x <= 0:
+                continue
+            flow[k] = x
+            ads_left[t] -= x
+            pubs_left[h] -= x
+            if ads_left[t] == 0:
+                u[t] = weights[k]
+            if pubs_left[h] == 0:
+                v[h] = weights[k]
+
+        u = numpy.array(u)
+        v = numpy.array(v)
+        ads_cap = numpy.maximum(0, numpy.asarray(ads_cap, dtype=int))
+        pubs_cap = numpy.maximum(0, numpy.asarray(pubs_cap, dtype=int))
+        zero = numpy.zeros(self.num_nodes)
+        self.bound = min(self._descend(u, v, ads_cap, pubs_cap, False, 0),
+                         self._descend(zero, zero, ads_cap, pubs_cap, False),
+                         self._descend(zero, zero, ads_cap, pubs_cap, True))
+        return numpy.array(flow, dtype=int)
+
+    def _descend(self, u, v, ads_cap, pubs_cap, v_first, rounds=None):
+        #the dual objective after rounds (default self.rounds) of coordinate descent from u
+        # and v, starting with u (or v if v_first)
+        if rounds is None:
+            rounds = self.rounds
+        for r in range(rounds):
+            if not v_first:
+                u = _dual_step(self.tails, self.weights - v[self.heads], self.caps, ads_cap, self.num_nodes)
+            v = _dual_step(self.heads, self.weights - u[self.tails], self.caps, pubs_cap, self.num_nodes)
+            if v_first:
+                u = _dual_step(self.tails, self.weights - v[self.heads], self.caps, ads_cap, self.num_nodes)
+        z = numpy.maximum(0.0, self.weights - u[self.tails] - v[self.heads])
+        return float(numpy.dot(ads_cap, u) + numpy.dot(pubs_cap, v) + numpy.dot(self.caps, z))
+
+    def settings(self):
+        return {'solver': 'greedy', 'rounds': self.rounds}
+
+    def fresh(self):
+        return GreedySolver(self.rounds)
+
+def _dual_step(nodes, reduced, caps, node_caps, num_nodes):
+    #the dual value y_i of each node minimizing node_caps_i*y_i + sum_k caps_k*max(0, reduced_k - y_i)
+    # over the edges k of node i (nodes[k] == i), y_i >= 0.  The slope below the value
+    # reduced_k of the j-th largest edge is node_caps_i minus the capacity of the first j
+    # edges, so the minimum is at the first edge where that capacity reaches node_caps_i,
+    # or 0 if it never does
+    y = numpy.zeros(num_nodes)
+    if len(nodes) == 0:
+        return y
+    #one sort by node, then by decreasing reduced weight
+    span = float(reduced.max() - reduced.min()) + 1.0
+    order = numpy.argsort(nodes*span + (reduced.max() - reduced))
+    nodes = nodes[order]
+    reduced = reduced[order]
+    total = numpy.cumsum(caps[order])
+    before = numpy.concatenate([[0], total])[numpy.searchsorted(nodes, nodes)]
+    hit = total - before > node_caps[nodes]
+    first_nodes,first = numpy.unique(nodes[hit], return_index=True)
+    y[first_nodes] = numpy.maximum(0.0, reduced[hit][first])
+    return y
+
+class AggregateSolver(Solver):
+    # Presolve by aggregation.  Two advertisers are equivalent if they have edges to the
+    #  same publishers with the same weights and capacities, two publishers if they have
+    #  edges from the same advertisers with the same weights and capacities (members of
+    #  a chain with the same type, location and prefered publishers, and no exclusions).
+    #  The edges between an advertiser class A and a publisher class B form a complete
+    #  bipartite block of equal weight and capacity, which becomes one edge of the
+    #  aggregated problem.  The capacities of a class are the sums of its members'
+    #  capacities.  Advertiser classes are nodes 0..nA-1 and publisher classes
+    #  nA..nA+nB-1 of the aggregated problem, solved by solver as in ComponentSolver.
+    #
+    # The classes and the aggregated problem depend only on the edges.  Each solve sets
+    #  the capacity of a block to the most its members can carry today: the sum of its
+    #  edge capacities, and of each member's capacity up to the capacity of its edges in
+    #  the block, on either side.  The aggregated problem stays a relaxation of the daily
+    #  problem, and the members' different balances do not make it loose.
+    #
+    # The flow of a block is split over its edges as a small transportation problem, in
+    #  order of decreasing weight.  If one side of the block is a single node the flow
+    #  is filled over the members of the other side, taking from the members with the
+    #  most capacity left, otherwise it is a maximum flow of the block (scipy's
+    #  maximum_flow).  If the split loses ads, the residual problem (the capacities left
+    #  on the edges and the members) is solved by solver and its flow added.  The flow is
+    #  optimal if it reaches the aggregated objective.  Otherwise the daily problem is
+    #  solved by solver without aggregation, fallbacks counts these solves.  bound is the
+    #  bound of the aggregated solve (None if solver is exact).
+
+    fallbacks = 0      #number of solves of the daily problem without aggregation
+    _isolated = False  #isolate the solvers made, see Solver._isolate()
+    _solver = None
+    _name = 'AdExchange'
+    _quiet = False
+    _sub = None        #Solver of the aggregated problem, None after a change
+    _full = None       #Solver of the daily problem, built at the first fallback
+    _ad_class = []     #advertiser class of each node, -1 without edges
+    _pub_class = []    #publisher class of each node, -1 without edges
+    _block = []        #block (edge of the aggregated problem) of each edge
+    _block_order = []  #edges sorted by block, block b is _block_order[_block_ptr[b]:_block_ptr[b+1]]
+    _block_ptr = []
+    _block_caps = []   #sum of the edge capacities of each block
+    _ad_pairs = None   #(block, node, capacity) of each advertiser of each block, see _pairs()
+    _pub_pairs = None  #(block, node, capacity) of each publisher of each block
+    _num_ad = 0        #number of advertiser classes
+
+    def __init__(self, solver=None, name='AdExchange', quiet=False):
+        self._solver = solver
+        self._name = name
+        self._quiet = quiet
+        self._sub = None
+        self._full = None
+
+    def _new_solver(self):
+        sub = _new_solver(self._solver, self._name, self._quiet)
+        if self._isolated:
+            sub._isolate()
+        return sub
+
+    def _isolate(self):
+        self._isolated = True
+
+    def _classes(self, nodes, other):
+        #class of each node, nodes with equal sorted (other, weight, cap) edge lists are equal
+        order = numpy.lexsort((other, nodes))
+        ptr = numpy.searchsorted(nodes[order], numpy.arange(self.num_nodes+1))
+        keys = {}
+        cls = numpy.zeros(self.num_nodes, dtype=int) - 1
+        for ii in numpy.nonzero(numpy.diff(ptr))[0].tolist():
+            e = order[ptr[ii]:ptr[ii+1]]
+            key = other[e].tobytes() + self.weights[e].tobytes() + self.caps[e].tobytes()
+            cls[ii] = keys.setdefault(key, len(keys))
+        return cls, len(keys)
+
+    def _pairs(self, nodes):
+        #the distinct (block, node) pairs of the edges, with the sum of the capacities of
+        # the node's edges in the block
+        keys,inverse = numpy.unique(self._block*self.num_nodes + nodes, return_inverse=True)
+        return keys//self.num_nodes, keys%self.num_nodes, numpy.bincount(inverse.reshape(-1), self.caps, len(keys))
+
+    def build(self, num_nodes, tails, heads, weights, caps, labels=None):
+        Solver.build(self, num_nodes, tails, heads, weights, caps)
+        self._sub = None
+        self._full = None
+
+    def _aggregate(self):
+        #the classes, blocks and aggregated problem of the current edges
+        self._ad_class,num_ad = self._classes(self.tails, self.heads)
+        self._pub_class,num_pub = self._classes(self.heads, self.tails)
+        self._num_ad = num_ad
+        num_pub = max(num_pub, 1)
+
+        pairs = self._ad_class[self.tails]*num_pub + self._pub_class[self.heads]
+        unique,self._block = numpy.unique(pairs, return_inverse=True)
+        self._block = self._block.reshape(-1)
+        self._block_order = numpy.argsort(self._block, kind='mergesort')
+        self._block_ptr = numpy.searchsorted(self._block[self._block_order], numpy.arange(len(unique)+1))
+        self._block_caps = numpy.bincount(self._block, self.caps, len(unique)).astype(int)
+        self._ad_pairs = self._pairs(self.tails)
+        self._pub_pairs = self._pairs(self.heads)
+        first = self._block_order[self._block_ptr[:-1]]
+
+        self._sub = self._new_solver()
+        self._sub.build(num_ad + num_pub, unique//num_pub, num_ad + unique%num_pub, self.weights[first], self._block_caps)
+
+    # The classes change with the nodes and edges.  A change drops the aggregated problem
+    #  and the next solve rebuilds it, so a burst of changes costs one rebuild
+
+    def add_nodes(self, labels):
+        Solver.add_nodes(self, labels)
+        self._sub = None
+        self._full = None
+
+    def add_edges(self, tails, heads, weights, caps):
+        Solver.add_edges(self, tails, heads, weights, caps)
+        self._sub = None
+        self._full = None
+
+    def update_edges(self, edges, weights, caps):
+        Solver.update_edges(self, edges, weights, caps)
+        self._sub = None
+        self._full = None
+
+    def num_variables(self):
+        #number of edges of the aggregated problem
+        if self._sub is None:
+            self._aggregate()
+        return len(self._block_ptr) - 1
+
+    def _today_caps(self, ads_left, pubs_left):
+        #capacity of each block with today's capacities of the members
+        num_blocks = len(self._block_caps)
+        caps = self._block_caps
+        for (block,node,edge_caps),left in [(self._ad_pairs, ads_left), (self._pub_pairs, pubs_left)]:
+            caps = numpy.minimum(caps, numpy.bincount(block, numpy.minimum(left[node], edge_caps), num_blocks))
+        return caps.astype(int)
+
+    def solve(self, ads_cap, pubs_cap):
+        if self._sub is None:
+            self._aggregate()
+        ads_left = numpy.maximum(0, numpy.asarray(ads_cap, dtype=int))
+        pubs_left = numpy.maximum(0, numpy.asarray(pubs_cap, dtype=int))
+        caps = self._today_caps(ads_left, pubs_left)
+        changed = numpy.nonzero(caps != self._sub.caps)[0]
+        if len(changed) > 0:
+            self._sub.update_edges(changed, self._sub.weights[changed], caps[changed])
+
+        num_ad = self._num_ad
+        num_pub = self._sub.num_nodes - num_ad
+        on = self._ad_class >= 0
+        sub_ads = numpy.zeros(self._sub.num_nodes, dtype=int)
+        sub_ads[:num_ad] = numpy.bincount(self._ad_class[on], ads_left[on], num_ad)
+        on = self._pub_class >= 0
+        sub_pubs = numpy.zeros(self._sub.num_nodes, dtype=int)
+        sub_pubs[num_ad:] = numpy.bincount(self._pub_class[on], pubs_left[on], num_pub)
+        block_flow = self._sub.solve(sub_ads, sub_pubs)
+        self.iterations = self._sub.iterations
+        self.bound = self._sub.bound
+        upper = self.bound
+        if upper is None:
+            upper = float(numpy.dot(self._sub.weights, block_flow))
+
+        #blocks of one edge take their flow as it is, the others are split by weight
+        flow = numpy.zeros(len(self.tails), dtype=int)
+        blocks = numpy.nonzero(block_flow)[0]
+        size = numpy.diff(self._block_ptr)[blocks]
+        single = blocks[size == 1]
+        edges = self._block_order[self._block_ptr[single]]
+        flow[edges] = block_flow[single]
+        ads_left -= numpy.bincount(self.tails[edges], flow[edges], self.num_nodes).astype(int)
+        pubs_left -= numpy.bincount(self.heads[edges], flow[edges], self.num_nodes).astype(int)
+        lost = 0
+        blocks = blocks[size > 1]
+        for b in blocks[numpy.argsort(-self._sub.weights[blocks], kind='mergesort')].tolist():
+            lost += self._split(int(block_flow[b]), self._block_order[self._block_ptr[b]:self._block_ptr[b+1]], ads_left, pubs_left, flow)
+        if lost > 0:
+            flow += self._residual(flow, ads_left, pubs_left)
+        if self._sub.bound is None and float(numpy.dot(self.weights, flow)) < upper - 1e-9*max(1.0, abs(upper)):
+            #not optimal, solve the daily problem itself
+            if self._full is None:
+                self._full = self._new_solver()
+                self._full.build(self.num_nodes, self.tails, self.heads, self.weights, self.caps)
+            flow = numpy.asarray(self._full.solve(ads_cap, pubs_cap), dtype=int)
+            self._count(self._full)
+            self.fallbacks += 1
+        return flow
+
+    def _split(self, total, edges, ads_left, pubs_left, flow):
+        #split the flow total of a block over its edges, return the ads that did not fit
+        tails = self.tails[edges]
+        heads = self.heads[edges]
+        if (heads == heads[0]).all():
+            x = _level_fill(min(total, int(pubs_left[heads[0]])), ads_left[tails], self.caps[edges])
+        elif (tails == tails[0]).all():
+            x = _level_fill(min(total, int(ads_left[tails[0]])), pubs_left[heads], self.caps[edges])
+        else:
+            x = _block_max_flow(total, tails, heads, self.caps[edges], ads_left, pubs_left)
+        flow[edges] += x
+        numpy.subtract.at(ads_left, tails, x)
+        numpy.subtract.at(pubs_left, heads, x)
+        return total - int(x.sum())
+
+    def _residual(self, flow, ads_left, pubs_left):
+        #flow of the residual problem: the edges with capacity left between members with
+        # capacity left, solved by solver
+        extra = numpy.zeros(len(self.tails), dtype=int)
+        edges = numpy.nonzero((self.caps > flow) & (ads_left[self.tails] > 0) & (pubs_left[self.heads] > 0))[0]
+        if len(edges) == 0:
+            return extra
+        nodes,local = numpy.unique(numpy.concatenate([self.tails[edges], self.heads[edges]]), return_inverse=True)
+        local = local.reshape(-1)
+        sub = self._new_solver()
+        sub.build(len(nodes), local[:len(edges)], local[len(edges):], self.weights[edges], self.caps[edges] - flow[edges])
+        extra[edges] = sub.solve(ads_left[nodes], pubs_left[nodes])
+        self._count(sub)
+        return extra
+
+    def _count(self, sub):
+        #add the iterations of another solve, None if either is not counted
+        self.iterations = None if None in [self.iterations, sub.iterations] else self.iterations + sub.iterations
+
+    def settings(self):
+        subs = [sub for sub in [self._sub, self._full] if sub is not None]
+        return {'solver': 'aggregate', 'inner': _inner_settings(self._solver, subs)}
+
+    def fresh(self):
+        return AggregateSolver(_fresh(self._solver), self._name, self._quiet)
+
+    def copy(self):
+        cpy = Solver.copy(self)
+        if self._sub is not None:
+            cpy._sub = self._sub.copy()
+        if self._full is not None:
+            cpy._full = self._full.copy()
+        return cpy
+
+def _level_fill(total, left, caps):
+    #integral x <= minimum(left, caps) summing to total (or to the most possible) that
+    # takes from the largest left first: x = clip(left - level, 0, caps) for an integral
+    # level, plus one for some of the nodes at the level
+    caps = numpy.minimum(left, caps)
+    total = min(total, int(caps.sum()))
+    if total <= 0:
+        return numpy.zeros(len(caps), dtype=int)
+    lo = 0
+    hi = int(left.max())
+    while hi - lo > 1:
+        mid = (lo + hi)//2
+        if numpy.minimum(numpy.maximum(left - mid, 0), caps).sum() >= total:
+            lo = mid
+        else:
+            hi = mid
+    x = numpy.minimum(numpy.maximum(left - hi, 0), caps)
+    more = numpy.nonzero(numpy.minimum(numpy.maximum(left - lo, 0), caps) > x)[0]
+    x[more[:total - int(x.sum())]] += 1
+    return x
+
+def _block_max_flow(total, tails, heads, caps, ads_left, pubs_left):
+    #flow on the edges of a maximum flow of at most total ads from the advertisers tails
+    # to the publishers heads, within caps and the capacities left
+    ads,t = numpy.unique(tails, return_inverse=True)
+    pubs,h = numpy.unique(heads, return_inverse=True)
+    t = t.reshape(-1) + 2
+    h = h.reshape(-1) + 2 + len(ads)
+    #node 0 is the source, 1 limits the flow to total and the last node is the sink
+    sink = 2 + len(ads) + len(pubs)
+    rows = numpy.concatenate([[0], numpy.ones(len(ads), dtype=int), t, numpy.arange(2 + len(ads), sink)])
+    cols = numpy.concatenate([[1], numpy.arange(2, 2 + len(ads)), h, numpy.zeros(len(pubs), dtype=int) + sink])
+    values = numpy.concatenate([[total], ads_left[ads], caps, pubs_left[pubs]]).astype(numpy.int32)
+    graph = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(sink+1, sink+1))
+    res = scipy.sparse.csgraph.maximum_flow(graph, 0, sink)
+    return numpy.asarray(res.flow[t, h]).reshape(-1).astype(int)
@@ -0,0 +1,101 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+# list of functions
+#
+# sweep(base,scenarios,days,processes=None,solver='flow'): simulate variants of an
+#   exchange in parallel and return a table of daily metrics
+#
+# A scenario is a dictionary of overrides applied to the base exchange before its model
+# is built.  The keys are optional:
+#
+#   'ads_per_day': {advertiser id: ads per day}
+#   'prefered':    {advertiser id: list of prefered publisher ids}
+#   'excluded':    {publisher id: list of excluded advertiser ids}
+#   'distances':   {(location, location): distance}, adds or changes edges of the map
+#
+# The base exchange is written once to a snapshot (AdExchange.save_snapshot) in a
+# temporary directory.  Each worker process memory-maps it, so the base data is shared
+# through the page cache instead of being pickled for every task.
+
+import multiprocessing
+import tempfile
+import shutil
+import os
+import numpy
+import advertiser
+
+def sweep(base, scenarios, days, processes=None, solver='flow'):
+    # simulate each scenario for days days, starting from the state of base.  Return a
+    #  table with a header row and one row per scenario and day: scenario index, day,
+    #  total ads, objective value, prefered ads and ads at each distance (as in
+    #  AdHistory.report_detailed_ads)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'base')
+        base.save_snapshot(path)
+        tasks = [(ii, scenario, days) for ii,scenario in enumerate(scenarios)]
+        if processes == 1:
+            _init_worker(path, solver)
+            results = [_run_scenario(t) for t in tasks]
+        else:
+            pool = multiprocessing.Pool(processes, _init_worker, (path, solver))
+            try:
+                results = pool.map(_run_scenario, tasks)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        shutil.rmtree(tmp)
+
+    return _result_table(results)
+
+def _result_table(results):
+    #merge the metrics of each scenario into one table
+    num_cat = max([r['detailed_ads'].shape[1] for ii,r in results] + [1])
+    header = ['scenario', 'day', 'total ads', 'objective', 'prefered']
+    header += ['distance ' + str(ii) for ii in range(num_cat-1)]
+    table = [header]
+    for ii,r in results:
+        for k in range(len(r['day'])):
+            detailed = r['detailed_ads'][k].tolist()
+            detailed += [0]*(num_cat - len(detailed))
+            table += [[ii, int(r['day'][k]), int(r['total_ads'][k]), float(r['objective'][k])] + detailed]
+    return table
+
+_worker = {} #state of a worker process: snapshot path and solver
+
+def _init_worker(path, solver):
+    _worker['path'] = path
+    _worker['solver'] = solver
+
+def _run_scenario(task):
+    #simulate one scenario, return its index and metrics
+    ii,scenario,days = task
+    adex = advertiser.AdExchange('Scenario ' + str(ii), True, _worker['solver'])
+    adex._load_snapshot(_worker['path'])
+    _apply(adex, scenario)
+    adex._build_graph_model()
+
+    batches = []
+    adex.simulate(adex._day + days, record=batches.append)
+    metrics = {'day': numpy.zeros(0, dtype=int), 'total_ads': numpy.zeros(0, dtype=int),
+               'objective': numpy.zeros(0), 'detailed_ads': numpy.zeros((0,1), dtype=int)}
+    if len(batches) > 0:
+        for key in metrics:
+            metrics[key] = numpy.concatenate([b[key] for b in batches])
+    return ii,metrics
+
+def _apply(adex, scenario):
+    #apply the overrides of a scenario to an exchange whose model is not yet built
+    table = adex._participants
+    index = dict((a_id,k) for k,a_id in enumerate(table.ids.tolist()))
+    for a_id,x in scenario.get('ads_per_day', {}).items():
+        table.ads_per_day[index[a_id]] = x
+    for a_id,x in scenario.get('prefered', {}).items():
+        table.prefered[index[a_id]] = list(x)
+    for a_id,x in scenario.get('excluded', {}).items():
+        table.excluded[index[a_id]] = list(x)
+    for (u,v),d in scenario.get('distances', {}).items():
+        adex._map.add_edge(u, v, distance=d)
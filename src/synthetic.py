@@ -0,0 +1,71 @@
+# Copyright 2013, all rights reserved.
+# Stephen Chestnut and Rico Zenklusen
+# Johns Hopkins University
+
+# list of functions
+#
+# synthetic_map(map_size): return a location map, a path of map_size locations
+# synthetic_exchange(num_participants,...): return an AdExchange with random participants
+#
+# The participants imitate dat/AdData.csv: a business type, a location, a number of ads
+# purchased per day, a list of prefered publishers and, for publishers, a publishing
+# capacity and a list of excluded advertisers.
+
+import networkx
+import numpy
+import advertiser
+
+def synthetic_map(map_size):
+    #locations 'L0',...,'L<map_size-1>' on a path, neighbors at distance 1
+    m = networkx.DiGraph()
+    locations = ['L' + str(ii) for ii in range(map_size)]
+    m.add_nodes_from(locations)
+    for u,v in zip(locations[:-1], locations[1:]):
+        m.add_edge(u, v, distance=1)
+        m.add_edge(v, u, distance=1)
+    return m
+
+def synthetic_exchange(num_participants, publisher_fraction=0.75, num_types=12, map_size=6,
+                       pref_length=5, excl_length=0, max_ads=500, max_pubs=1000,
+                       seed=None, solver=None, quiet=True, build=True):
+    #return an AdExchange with num_participants random participants.  Each one is a
+    # publisher with probability publisher_fraction, has one of num_types business types,
+    # one of map_size locations, up to max_ads ads purchased per day, pref_length
+    # prefered publishers and (publishers) up to max_pubs ads published per day and
+    # excl_length excluded advertisers.  If build is True the model is built and the
+    # first day is solved, as AdExchange.from_sample_data() does
+    rng = numpy.random.RandomState(seed)
+    inst = advertiser.AdExchange('Synthetic', quiet, solver)
+    inst._map = synthetic_map(map_size)
+    inst._distances = None
+
+    n = num_participants
+    ids = numpy.arange(1, n+1)
+    is_pub = rng.rand(n) < publisher_fraction
+    pub_ids = ids[is_pub]
+    types = ['T' + str(t) for t in rng.randint(0, num_types, n).tolist()]
+    locs = ['L' + str(l) for l in rng.randint(0, map_size, n).tolist()]
+    ads = rng.randint(0, max_ads+1, n)
+    pubs = numpy.where(is_pub, 2*rng.randint(1, max_pubs//2 + 1, n), 0)
+
+    pref = []
+    excl = []
+    for ii in range(n):
+        pref += [_sample(rng, pub_ids, pref_length).tolist()]
+        if is_pub[ii]:
+            excl += [_sample(rng, ids, excl_length).tolist()]
+        else:
+            excl += [[]]
+
+    inst._participants.extend(ids, ['Business ' + str(a_id) for a_id in ids.tolist()], types,
+                              ads, pubs, locs, pref, excl, is_pub)
+    if build:
+        inst._build_graph_model()
+        inst.update()
+    return inst
+
+def _sample(rng, ids, k):
+    #k distinct ids, or all of them if there are fewer than k
+    if len(ids) <= k:
+        return ids
+    return rng.choice(ids, k, replace=False)